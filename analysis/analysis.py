@@ -1,59 +1,322 @@
 import json
+import numpy as np
+import os
 import pandas as pd
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
 from pathlib import Path
 import logging
 from matplotlib.ticker import FuncFormatter
+from pandas.api.types import union_categoricals
 
+CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "walker"
+# Bump when `parse_iperf` output changes, so cached results are parsed again
+PARSE_VERSION = 4
 
-def get_iperf(source: Path) -> pd.DataFrame:
+
+def read_iperf(source: Path) -> dict:
+    """Reads iperf3 result, either a `--json` document or `--json-stream` lines.
+
+    Stream events are merged into the layout of the `--json` document. A
+    truncated last line (interrupted measurement) is ignored.
+    """
     with source.open("r") as f:
-        raw_data = json.load(f)
+        text = f.read()
+    try:
+        raw_data = json.loads(text)
+    except ValueError:
+        pass
+    else:
+        # A stream holding the title event only is a single JSON document too
+        if "event" not in raw_data:
+            return raw_data
+
+    raw_data = {"intervals": []}
+    for line in text.splitlines():
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event["event"] == "interval":
+            raw_data["intervals"].append(event["data"])
+        else:
+            raw_data[event["event"]] = event["data"]
+    return raw_data
+
+
+def parse_iperf(source: Path) -> tuple:
+    """Parses iperf3 result into compact per-interval arrays.
+
+    Returns:
+        tuple: (meta, arrays, totals) where `meta` holds the per-file values,
+        `arrays` maps every interval field to a numpy array and `totals`
+        holds the UDP totals of the file (`lost_packets`, `jitter_ms`), which
+        are not copied onto the intervals
+    """
+    raw_data = read_iperf(source)
 
     intervals = [x["streams"][0] for x in raw_data["intervals"]]
     if not intervals:
         raise ValueError("Missing data")
 
-    result = pd.DataFrame(intervals)
+    fields = list(intervals[0])
+    arrays = {key: np.array([x.get(key) for x in intervals]) for key in fields}
 
-    result["Client"] = raw_data["title"].split(" ")[3]
-    result["Access Point"] = raw_data["title"].split(" ")[1]
-    result["Kernel"] = raw_data["start"]["system_info"].split(" ")[2]
+    # Number of stations measured at the same time (see `experiment.py multi`)
+    concurrency = re.search(r" concurrency (\d+)", raw_data["title"])
+    # UDP totals, missing for TCP and for interrupted measurements
+    end = raw_data.get("end", {}).get("sum", {})
+    meta = {
+        "Client": raw_data["title"].split(" ")[3],
+        "Access Point": raw_data["title"].split(" ")[1],
+        "Kernel": raw_data["start"]["system_info"].split(" ")[2],
+        "Timestamp": raw_data["start"]["timestamp"]["time"],
+        "System Info": raw_data["start"]["system_info"],
+        "Protocol": raw_data["start"]["test_start"]["protocol"],
+        "Concurrency": int(concurrency.group(1)) if concurrency else 1,
+        "file": source.stem,
+    }
+    totals = {
+        "lost_packets": float(end.get("lost_packets", np.nan)),
+        "jitter_ms": float(end.get("jitter_ms", np.nan)),
+    }
+    return meta, arrays, totals
 
-    result["Timestamp"] = raw_data["start"]["timestamp"]["time"]
-    result["System Info"] = raw_data["start"]["system_info"]
-    result["Protocol"] = raw_data["start"]["test_start"]["protocol"]
 
-    result["Connection"] = [
-        "{0[0]}\n{0[1]}".format(sorted(elem))
-        for elem in zip(result["Access Point"], result["Client"])
-    ]
+def iperf_frame(parsed: list) -> pd.DataFrame:
+    """Builds one frame from `parse_iperf` outputs of several files.
+
+    Per-file values are stored as categoricals (codes repeated over the
+    intervals of each file) and integer columns use the narrowest dtype.
+    """
+    if not parsed:
+        raise ValueError("Missing data")
+    lengths = [len(next(iter(arrays.values()))) for _, arrays, _ in parsed]
+    fields = list(dict.fromkeys(key for _, arrays, _ in parsed for key in arrays))
 
-    result["file"] = source.stem
+    result = {}
+    for key in fields:
+        column = np.concatenate(
+            [
+                arrays[key] if key in arrays else np.full(length, np.nan)
+                for (_, arrays, _), length in zip(parsed, lengths)
+            ]
+        )
+        # Floats stay float64, throughput in bit/s needs the precision
+        if column.dtype.kind in "iu":
+            column = pd.to_numeric(column, downcast="integer")
+        result[key] = column
 
+    codes = np.repeat(np.arange(len(parsed)), lengths)
+    per_file = {key: [meta[key] for meta, _, _ in parsed] for key in parsed[0][0]}
+    per_file["Connection"] = [
+        "\n".join(sorted([meta["Access Point"], meta["Client"]]))
+        for meta, _, _ in parsed
+    ]
+    per_file["file"] = per_file.pop("file")
+    for key, values in per_file.items():
+        categories = pd.Categorical(values)
+        result[key] = pd.Categorical.from_codes(
+            categories.codes[codes], categories.categories
+        )
+
+    result = pd.DataFrame(result)
     result.columns = [x.replace("_", " ") for x in result.columns]
     result = result.rename(columns={"bits per second": "Throughput [Mbps]"})
 
     return result
 
 
-def get_iperf_folder(source: Path, recursive: bool = False) -> pd.DataFrame:
-    dfl = []
-    if recursive:
-        file_list = source.rglob("*.json")
-    else:
-        file_list = source.glob("*.json")
+def concat(frames: list) -> pd.DataFrame:
+    """Concatenates frames keeping categorical columns categorical"""
+    frames = list(frames)
+    result = pd.concat(frames, ignore_index=True)
+    for key in frames[0].select_dtypes("category").columns:
+        result[key] = union_categoricals(
+            [df[key] for df in frames], ignore_order=True
+        )
+    return result
+
+
+class ParseCache:
+    """On-disk cache of parsed iperf results.
+
+    Entries are keyed by the resolved path, size and modification time of the
+    result file and hold the output of `parse_iperf` pickled (numpy arrays are
+    stored as raw buffers). The least recently used entries are evicted once
+    the cache grows over `max_size` bytes.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, max_size: int = 2 ** 30):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    def entry(self, source: Path) -> Path:
+        stat = source.stat()
+        key = f"{PARSE_VERSION}:{source.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.path / (sha256(key.encode("utf-8")).hexdigest() + ".pkl")
+
+    def get(self, source: Path):
+        """Returns cached `parse_iperf` output, None for files without data
+
+        Raises:
+            KeyError: `source` is not cached
+        """
+        entry = self.entry(source)
+        try:
+            with entry.open("rb") as f:
+                parsed = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            raise KeyError(source) from e
+        os.utime(entry)
+        return parsed
 
+    def put(self, source: Path, parsed):
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = self.entry(source)
+        tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(entry)
+
+    def evict(self):
+        entries = []
+        for entry in self.path.glob("*.pkl"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry.unlink()
+            total -= size
+
+
+def get_cache(cache) -> ParseCache:
+    """Resolves `cache` argument: True for default cache, False/None to disable"""
+    if cache is True:
+        return ParseCache()
+    return cache or None
+
+
+def get_iperf(source: Path, cache=False) -> pd.DataFrame:
+    cache = get_cache(cache)
+    if cache is None:
+        return iperf_frame([parse_iperf(source)])
+    try:
+        parsed = cache.get(source)
+    except KeyError:
+        parsed = parse_iperf_chunk([source])[0]
+        cache.put(source, parsed)
+        cache.evict()
+    if parsed is None:
+        raise ValueError("Missing data")
+    return iperf_frame([parsed])
+
+
+def parse_iperf_chunk(file_list: list) -> list:
+    """Worker parsing a batch of files, None for files without data"""
+    parsed = []
     for fname in file_list:
         logging.debug(f"loading {fname}")
         try:
-            df1 = get_iperf(fname)
-            dfl.append(df1)
+            parsed.append(parse_iperf(fname))
         except ValueError:
-            continue
-    df = pd.concat(dfl)
+            parsed.append(None)
+    return parsed
+
+
+def get_iperf_folder(
+    source: Path,
+    recursive: bool = False,
+    store: Path = None,
+    columns: list = None,
+    filters: dict = None,
+    workers: int = None,
+    cache=True,
+) -> pd.DataFrame:
+    """Loads all iperf results from `source`.
+
+    Files are parsed by a pool of `workers` processes (one per CPU by
+    default, `workers=1` parses in this process). Parsed files are kept in
+    `cache` (a `ParseCache`, True for the default one, False to disable), so
+    only new or changed files are parsed again.
+
+    With `store` given, runs are read from the columnar store (see
+    `store.py`) and runs missing there are ingested first. `columns` and
+    `filters` are then applied while reading from disk.
+    """
+    if store is not None:
+        import store as result_store
+
+        result_store.ingest(source, store, recursive)
+        runs = result_store.run_files(source, recursive)
+        return result_store.read(store, runs, columns, filters)
+
+    if recursive:
+        file_list = sorted(source.rglob("*.json"))
+    else:
+        file_list = sorted(source.glob("*.json"))
+
+    cache = get_cache(cache)
+    parsed = {}
+    if cache is not None:
+        for fname in file_list:
+            try:
+                parsed[fname] = cache.get(fname)
+            except KeyError:
+                continue
+    missing = [fname for fname in file_list if fname not in parsed]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(missing))
+    if workers > 1:
+        # Several batches per worker keep the pool busy until the end
+        size = -(-len(missing) // (workers * 4))
+        chunks = [missing[i : i + size] for i in range(0, len(missing), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [
+                p for chunk in executor.map(parse_iperf_chunk, chunks) for p in chunk
+            ]
+    else:
+        results = parse_iperf_chunk(missing)
+
+    for fname, result in zip(missing, results):
+        parsed[fname] = result
+        if cache is not None:
+            cache.put(fname, result)
+    if cache is not None and missing:
+        cache.evict()
+
+    df = iperf_frame([parsed[fname] for fname in file_list if parsed[fname]])
     return df
 
 
+def aggregate_throughput(df: pd.DataFrame) -> pd.DataFrame:
+    """Sums throughput of concurrently measured stations per interval.
+
+    Clients of a concurrent measurement start together, so their intervals
+    line up by `start`. `df` should hold a single run.
+
+    Returns:
+        pd.DataFrame: aggregate throughput per kernel, AP, concurrency level
+        and interval start
+    """
+    return (
+        df.groupby(["Kernel", "Access Point", "Concurrency", "start"], observed=True)[
+            "Throughput [Mbps]"
+        ]
+        .sum()
+        .reset_index()
+    )
+
+
 def bitrate(x, pos):
     "The two args are the value and tick position"
     return "{:1.0f}".format(x * 1e-6)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+CATALOG_NAME = "catalog.parquet"
+KEYS = ["Run", "Kernel", "Access Point", "Client", "Concurrency", "file"]
+VALUE = "Throughput [Mbps]"
+
+# Throughput quantiles are kept in sketches with fixed logarithmic buckets
+# (as DDSketch), so sketches of any files are merged by adding their counts.
+# Quantiles are within ACCURACY (relative) of the exact ones, values up to LOW
+# (in bit/s) are counted as 0 and values over HIGH as HIGH. Only non-empty
+# buckets are stored.
+ACCURACY = 0.01
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+LOW = 1e3
+HIGH = 1e11
+BINS = int(np.ceil(np.log(HIGH / LOW) / np.log(GAMMA))) + 1
+
+SCHEMA = pa.schema(
+    [
+        ("Run", pa.string()),
+        ("Kernel", pa.string()),
+        ("Access Point", pa.string()),
+        ("Client", pa.string()),
+        ("Concurrency", pa.int16()),
+        ("file", pa.string()),
+        ("Time", pa.timestamp("s", tz="UTC")),
+        ("intervals", pa.int32()),
+        ("sum", pa.float64()),
+        ("sum_sq", pa.float64()),
+        ("min", pa.float64()),
+        ("max", pa.float64()),
+        ("packets", pa.float64()),
+        ("lost_packets", pa.float64()),
+        ("jitter_ms", pa.float64()),
+        ("sketch_bins", pa.list_(pa.int16())),
+        ("sketch_counts", pa.list_(pa.int32())),
+    ]
+)
+SKETCH = ["sketch_bins", "sketch_counts"]
+
+
+def bucket(values: np.ndarray) -> np.ndarray:
+    """Returns sketch bucket of every value"""
+    values = np.clip(np.nan_to_num(values, nan=0.0), LOW, HIGH)
+    return np.ceil(np.log(values / LOW) / np.log(GAMMA)).astype(np.int64)
+
+
+def quantile(sketches: np.ndarray, q) -> np.ndarray:
+    """Returns quantile `q` of every dense sketch, NaN for empty ones
+
+    Args:
+        sketches (np.ndarray): bucket counts, (sketches, BINS) array
+    """
+    cumulative = np.cumsum(sketches, axis=-1)
+    total = cumulative[..., -1:]
+    index = (cumulative > q * (total - 1)).argmax(axis=-1)
+    values = np.where(index > 0, 2 * LOW * GAMMA ** index / (GAMMA + 1), 0.0)
+    return np.where(total[..., 0] > 0, values, np.nan)
+
+
+def summarize(df: pd.DataFrame, totals: pd.DataFrame = None) -> pd.DataFrame:
+    """Summarizes intervals of every result file of a run.
+
+    Args:
+        df (pd.DataFrame): intervals of one run, with a `Run` column
+        totals (pd.DataFrame): UDP totals (`lost_packets`, `jitter_ms`) of
+            the result files, indexed by `file` (see `analysis.parse_iperf`)
+
+    Returns:
+        pd.DataFrame: one catalog row per result file
+    """
+    # Packet counts are only reported for UDP
+    if "packets" not in df:
+        df = df.assign(packets=np.nan)
+    groups = df.groupby(KEYS, observed=True, sort=False)
+    codes = groups.ngroup().to_numpy()
+    values = df[VALUE].to_numpy(dtype=float)
+
+    summary = groups.agg(
+        Timestamp=("Timestamp", "first"),
+        intervals=(VALUE, "size"),
+        sum=(VALUE, "sum"),
+        min=(VALUE, "min"),
+        max=(VALUE, "max"),
+        packets=("packets", lambda x: x.sum(min_count=1)),
+    ).reset_index()
+    for name in ["lost_packets", "jitter_ms"]:
+        if totals is None or name not in totals:
+            summary[name] = np.nan
+        else:
+            summary[name] = summary["file"].astype(str).map(totals[name])
+    summary["sum_sq"] = np.bincount(codes, np.square(values), len(summary))
+    summary["Time"] = pd.to_datetime(
+        summary.pop("Timestamp").astype(str), format="%a, %d %b %Y %H:%M:%S %Z"
+    )
+
+    cells, counts = np.unique(codes * BINS + bucket(values), return_counts=True)
+    splits = np.searchsorted(cells // BINS, np.arange(1, len(summary)))
+    summary["sketch_bins"] = np.split((cells % BINS).astype(np.int16), splits)
+    summary["sketch_counts"] = np.split(counts.astype(np.int32), splits)
+
+    for name in KEYS:
+        summary[name] = summary[name].astype(str)
+    summary["Concurrency"] = summary["Concurrency"].astype(int)
+    for name in ["packets", "lost_packets", "jitter_ms"]:
+        summary[name] = summary[name].astype(float)
+    return summary[SCHEMA.names]
+
+
+def write(store: Path, summary: pd.DataFrame):
+    """Replaces the catalog of the store with `summary`"""
+    table = pa.Table.from_pandas(summary, schema=SCHEMA, preserve_index=False)
+    store.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, store / CATALOG_NAME)
+
+
+def read_table(store: Path, columns: list = None, filters: list = None) -> pa.Table:
+    """Reads catalog rows, an empty table if the store has no catalog yet
+
+    Args:
+        store (Path): store location
+        columns (list): columns to read, all if None
+        filters (list): pyarrow filters, e.g. `[("Kernel", "==", "4.14.5")]`
+    """
+    path = store / CATALOG_NAME
+    if not path.exists():
+        table = SCHEMA.empty_table()
+        return table if columns is None else table.select(columns)
+    return pq.read_table(path, columns=columns, filters=filters or None)
+
+
+def read(store: Path, filters: list = None) -> pd.DataFrame:
+    """Reads catalog rows, one per ingested result file"""
+    return read_table(store, filters=filters).to_pandas()
+
+
+def merge_sketches(table: pa.Table, codes: np.ndarray, groups: int) -> np.ndarray:
+    """Adds up sketches of the catalog rows with the same group code
+
+    Returns:
+        np.ndarray: dense sketch of every group, (groups, BINS) array
+    """
+    bins = table["sketch_bins"].combine_chunks()
+    counts = table["sketch_counts"].combine_chunks()
+    lengths = pc.list_value_length(bins).to_numpy(zero_copy_only=False)
+    cells = np.repeat(codes, lengths) * BINS + bins.flatten().to_numpy()
+    merged = np.bincount(
+        cells, counts.flatten().to_numpy(), minlength=groups * BINS
+    )
+    return merged.reshape(groups, BINS)
+
+
+def query(
+    store: Path,
+    kernel=None,
+    ap=None,
+    sta=None,
+    since=None,
+    until=None,
+    by=("Kernel",),
+    quantiles=(0.05, 0.5, 0.95),
+) -> pd.DataFrame:
+    """Throughput and loss statistics of the matching runs, from the catalog.
+
+    Only the catalog is read, statistics of the selected result files are
+    merged per `by` group. `kernel`, `ap` and `sta` take a value or a list of
+    values.
+
+    Args:
+        store (Path): store location
+        kernel: kernel release(s) to select
+        ap: access point(s) to select
+        sta: station(s) to select
+        since: first date (or time) of the measurements to select
+        until: last date of the measurements to select (included)
+        by (list): catalog columns to group by, e.g. `["Kernel", "Client"]`
+        quantiles (list): throughput quantiles to compute
+
+    Returns:
+        pd.DataFrame: one row per group with the number of files and
+        intervals, throughput min, max, mean, std and quantiles (in bit/s),
+        and UDP loss ratio
+    """
+    filters = []
+    for name, value in [("Kernel", kernel), ("Access Point", ap), ("Client", sta)]:
+        if isinstance(value, (list, tuple, set)):
+            filters.append((name, "in", list(value)))
+        elif value is not None:
+            filters.append((name, "==", value))
+    if since is not None:
+        filters.append(("Time", ">=", pd.Timestamp(since, tz="UTC")))
+    if until is not None:
+        until = pd.Timestamp(until, tz="UTC")
+        if until == until.normalize():
+            until += pd.Timedelta(days=1)
+        filters.append(("Time", "<", until))
+
+    by = [by] if isinstance(by, str) else list(by)
+    columns = SCHEMA.names if quantiles else SCHEMA.names[: -len(SKETCH)]
+    table = read_table(store, columns, filters)
+    # Loss of the files with a UDP total only (not interrupted)
+    udp_packets = pc.if_else(
+        pc.is_valid(table["lost_packets"]), table["packets"], pa.scalar(None)
+    )
+    table = table.append_column("udp_packets", udp_packets)
+    table = table.append_column("row", pa.array(np.arange(len(table))))
+
+    grouped = (
+        table.group_by(by)
+        .aggregate(
+            [
+                ("file", "count"),
+                ("intervals", "sum"),
+                ("sum", "sum"),
+                ("sum_sq", "sum"),
+                ("min", "min"),
+                ("max", "max"),
+                ("udp_packets", "sum"),
+                ("lost_packets", "sum"),
+                ("row", "list"),
+            ]
+        )
+        .sort_by([(name, "ascending") for name in by])
+    )
+
+    def column(name):
+        return grouped[name].to_numpy(zero_copy_only=False)
+
+    n = column("intervals_sum")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = column("sum_sum") / n
+        variance = (column("sum_sq_sum") - n * mean ** 2) / (n - 1)
+        stats = {
+            "files": column("file_count"),
+            "intervals": n,
+            "min": column("min_min"),
+            "max": column("max_max"),
+            "mean": mean,
+            "std": np.sqrt(np.maximum(variance, 0)),
+            "loss": column("lost_packets_sum") / column("udp_packets_sum"),
+        }
+
+    if quantiles:
+        rows = grouped["row_list"].combine_chunks()
+        codes = np.empty(len(table), dtype=np.int64)
+        codes[rows.flatten().to_numpy()] = np.repeat(
+            np.arange(len(rows)), pc.list_value_length(rows).to_numpy()
+        )
+        merged = merge_sketches(table, codes, len(rows))
+        for q in quantiles:
+            stats[f"p{100 * q:g}"] = quantile(merged, q)
+
+    if len(by) == 1:
+        index = pd.Index(column(by[0]), name=by[0])
+    else:
+        index = pd.MultiIndex.from_arrays([column(name) for name in by], names=by)
+    return pd.DataFrame(stats, index=index)
+
+
+@click.command(short_help="Query summary statistics of ingested runs")
+@click.argument("store", type=click.Path(exists=True, file_okay=False))
+@click.option("--kernel", "-k", multiple=True, help="Kernel release")
+@click.option("--ap", multiple=True, help="Access point")
+@click.option("--sta", multiple=True, help="Station")
+@click.option("--since", help="First date, e.g. 2018-01-17")
+@click.option("--until", help="Last date (included)")
+@click.option("--by", "-b", multiple=True, help="Group by column (default Kernel)")
+def cli(store, kernel, ap, sta, since, until, by):
+    result = query(
+        Path(store),
+        kernel=kernel or None,
+        ap=ap or None,
+        sta=sta or None,
+        since=since,
+        until=until,
+        by=by or ("Kernel",),
+    )
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        click.echo(result)
+
+
+if __name__ == "__main__":
+    # pylint: disable=no-value-for-parameter
+    cli()
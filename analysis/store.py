@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import click
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import shutil
+import uuid
+
+from pathlib import Path
+
+import analysis
+import catalog
+
+PARTITIONS = ["Run", "Kernel", "Access Point", "Client"]
+INDEX_COLUMNS = PARTITIONS + ["file", "Timestamp", "intervals"]
+INDEX_NAME = "index.parquet"
+DATA_NAME = "intervals"
+
+# Every run directory (e.g. `data/2018-01-17-144113`) is stored as a Parquet
+# dataset partitioned by run, kernel, AP and STA
+
+partitioning = ds.partitioning(
+    pa.schema([(name, pa.string()) for name in PARTITIONS]), flavor="hive"
+)
+
+
+def read_index(store: Path) -> pd.DataFrame:
+    """Returns index of the store, one row per ingested result file"""
+    index_path = store / INDEX_NAME
+    if not index_path.exists():
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    return pd.read_parquet(index_path)
+
+
+def run_files(source: Path, recursive: bool = False) -> dict:
+    """Maps run name to the result files of this run found in `source`"""
+    if recursive:
+        file_list = source.rglob("*.json")
+    else:
+        file_list = source.glob("*.json")
+
+    runs = {}
+    for fname in sorted(file_list):
+        runs.setdefault(fname.parent.name, []).append(fname)
+    return runs
+
+
+def ingest_run(store: Path, run: str, files: list) -> tuple:
+    """Converts result files of one run into the store.
+
+    Previously stored data of this run is replaced.
+
+    Returns:
+        tuple: (index, summary) rows of the run, see `catalog.summarize`
+    """
+    run_path = store / DATA_NAME / f"Run={run}"
+    if run_path.exists():
+        shutil.rmtree(run_path)
+
+    dfl = []
+    index = []
+    totals = {}
+    for fname in files:
+        logging.debug(f"ingesting {fname}")
+        try:
+            parsed = analysis.parse_iperf(fname)
+        except ValueError:
+            index.append({"Run": run, "file": fname.stem, "intervals": 0})
+            continue
+        df1 = analysis.iperf_frame([parsed])
+        totals[fname.stem] = parsed[2]
+        df1["Run"] = run
+        dfl.append(df1)
+        index.append(
+            dict(
+                zip(
+                    INDEX_COLUMNS,
+                    [
+                        run,
+                        df1["Kernel"].iloc[0],
+                        df1["Access Point"].iloc[0],
+                        df1["Client"].iloc[0],
+                        df1["file"].iloc[0],
+                        df1["Timestamp"].iloc[0],
+                        len(df1),
+                    ],
+                )
+            )
+        )
+    if not dfl:
+        summary = catalog.SCHEMA.empty_table().to_pandas()
+        return pd.DataFrame(columns=INDEX_COLUMNS), summary
+
+    df = analysis.concat(dfl)
+    summary = catalog.summarize(df, pd.DataFrame.from_dict(totals, orient="index"))
+    for name in PARTITIONS:
+        df[name] = df[name].astype(str)
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        store / DATA_NAME,
+        format="parquet",
+        partitioning=partitioning,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return pd.DataFrame(index, columns=INDEX_COLUMNS), summary
+
+
+def ingest(
+    source: Path, store: Path, recursive: bool = False, force: bool = False
+) -> pd.DataFrame:
+    """Ingests all runs found in `source` that are missing in the store.
+
+    Summary statistics of every result file are kept in the catalog (see
+    `catalog.py`), runs stored before the catalog existed are ingested again.
+
+    Args:
+        source (Path): run directory, or folder with run directories
+        store (Path): store location
+        recursive (bool): search `source` recursively
+        force (bool): ingest runs again, even if they are already stored
+
+    Returns:
+        pd.DataFrame: updated index
+    """
+    index = read_index(store)
+    summary = catalog.read(store)
+    for run, files in run_files(source, recursive).items():
+        stored = index[index["Run"] == run]
+        complete = set(stored["file"]) >= {f.stem for f in files}
+        summarized = run in set(summary["Run"]) or not stored["intervals"].any()
+        if not force and complete and summarized:
+            continue
+        logging.info(f"ingesting run {run}")
+        run_index, run_summary = ingest_run(store, run, files)
+        index = pd.concat([index[index["Run"] != run], run_index], ignore_index=True)
+        summary = pd.concat(
+            [summary[summary["Run"] != run], run_summary], ignore_index=True
+        )
+        store.mkdir(parents=True, exist_ok=True)
+        index.to_parquet(store / INDEX_NAME, index=False)
+        catalog.write(store, summary)
+    return index
+
+
+def read(
+    store: Path, runs: list = None, columns: list = None, filters: dict = None
+) -> pd.DataFrame:
+    """Reads intervals from the store.
+
+    Only the requested columns and the partitions matching `runs` and
+    `filters` are read from disk.
+
+    Args:
+        store (Path): store location
+        runs (list): runs to read, all if None
+        columns (list): columns to read, all if None
+        filters (dict): column name to a value (or list of values) to select,
+            e.g. `{"Kernel": "4.14.5-041405-generic"}`
+
+    Returns:
+        pd.DataFrame: selected intervals
+    """
+    dataset = ds.dataset(store / DATA_NAME, format="parquet", partitioning=partitioning)
+    selection = dict(filters or {})
+    if runs is not None:
+        selection["Run"] = list(runs)
+
+    expression = None
+    for name, value in selection.items():
+        if isinstance(value, (list, tuple, set)):
+            condition = ds.field(name).isin(list(value))
+        else:
+            condition = ds.field(name) == value
+        expression = condition if expression is None else expression & condition
+
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas(strings_to_categorical=True)
+
+
+@click.command(short_help="Ingest iperf results into columnar store")
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+@click.argument("store", type=click.Path(file_okay=False))
+@click.option("--recursive", "-r", is_flag=True, help="Search source recursively")
+@click.option("--force", "-f", is_flag=True, help="Ingest already stored runs")
+def cli(source, store, recursive, force):
+    logging.basicConfig(level=logging.INFO)
+    index = ingest(Path(source), Path(store), recursive, force)
+    click.echo(index.groupby(["Run", "Kernel"]).size())
+
+
+if __name__ == "__main__":
+    # pylint: disable=no-value-for-parameter
+    cli()
@@ -0,0 +1,38 @@
+import networkx as nx
+import pandas as pd
+import twistmap
+
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+
+
+def render(model):
+    """Serializes `model` to a standalone page, as shown in the notebooks"""
+    return file_html(model, CDN, "twistmap")
+
+
+def test_draw_graph():
+    nodes = list(twistmap.load_nodes().index[:3])
+    G = nx.Graph()
+    G.add_edges_from(zip(nodes, nodes[1:]))
+
+    plot = twistmap.draw_graph(twistmap.create_map(), G)
+
+    assert "<html" in render(plot)
+
+
+def test_link_map():
+    ap, sta = twistmap.load_nodes().index[:2]
+    df = pd.DataFrame(
+        {
+            "Kernel": ["4.14.5", "4.14.5", "3.18.87"],
+            "Access Point": [ap, sta, ap],
+            "Client": [sta, ap, sta],
+            "Throughput [Mbps]": [80.0, 60.0, 40.0],
+        }
+    )
+    links = twistmap.LinkMap(twistmap.pair_matrix(df))
+    links.select("4.14.5")
+
+    assert list(links.source.data["throughput"]) == [80.0, 60.0]
+    assert "<html" in render(links.layout())
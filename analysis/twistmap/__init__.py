@@ -1,18 +1,24 @@
-# import numpy as np
-
-import networkx as nx
+import functools
+import numpy as np
 import pandas as pd
 
+from bokeh.layouts import column
 from bokeh.models import BoxSelectTool
-from bokeh.models import Circle
+from bokeh.models import ColorBar
+from bokeh.models import ColumnDataSource
+from bokeh.models import CustomJS
 from bokeh.models import HoverTool
 from bokeh.models import MultiLine
+from bokeh.models import Scatter
+from bokeh.models import Select
 from bokeh.models import TapTool
 from bokeh.models.graphs import EdgesAndLinkedNodes
 from bokeh.models.graphs import NodesAndLinkedEdges
-from bokeh.models.graphs import from_networkx
 from bokeh.palettes import Spectral4
+from bokeh.palettes import Viridis256
 from bokeh.plotting import figure
+from bokeh.plotting import from_networkx
+from bokeh.transform import linear_cmap
 from pathlib import Path
 
 CURR_PATH = Path(__file__).parent
@@ -26,27 +32,42 @@ background = {
     "resolution": 0.01,
 }
 
-nodes = pd.read_csv(CURR_PATH / "wifi_nodes.csv")
-nodes["floor"] = nodes["room"].str[2].astype(int)
-nodes = nodes[(nodes["floor"] == 3) & (nodes["status"] == "on")]
-nodes = nodes[nodes["platform"] == "nuc"]
 
-node_positions = nodes.set_index("node_id")[["x", "y"]].to_dict("index")
-for key in node_positions:
-    pos = node_positions[key]
-    node_positions[key] = (pos["x"], pos["y"])
+@functools.lru_cache(maxsize=None)
+def load_nodes() -> pd.DataFrame:
+    """Returns NUC nodes on the 3rd floor that are on, read on first use"""
+    nodes = pd.read_csv(CURR_PATH / "wifi_nodes.csv")
+    nodes["floor"] = nodes["room"].str[2].astype(int)
+    nodes = nodes[(nodes["floor"] == 3) & (nodes["status"] == "on")]
+    return nodes[nodes["platform"] == "nuc"].set_index("node_id", drop=False)
+
+
+@functools.lru_cache(maxsize=None)
+def load_positions() -> dict:
+    """Returns position `(x, y)` of every node in `load_nodes`"""
+    xy = load_nodes()[["x", "y"]]
+    return dict(zip(xy.index, zip(xy["x"], xy["y"])))
+
+
+def __getattr__(name):
+    # `nodes` and `node_positions` used to be read at import time
+    if name == "nodes":
+        return load_nodes().reset_index(drop=True)
+    if name == "node_positions":
+        return load_positions()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def create_map():
     p = figure(
         x_range=(-1, 32),
         y_range=(-1, 16),
-        plot_width=320,
-        plot_height=160,
+        width=320,
+        height=160,
         toolbar_location="above",
         title="TWIST 3rd floor",
         sizing_mode="scale_width",
-        # output_backend="webgl",
+        output_backend="webgl",
     )
     p.xaxis.axis_label = "X [m]"
     p.yaxis.axis_label = "Y [m]"
@@ -64,13 +85,13 @@ def create_map():
 
 def draw_graph(plot, G):
     plot.add_tools(HoverTool(tooltips=None), TapTool(), BoxSelectTool())
-    graph = from_networkx(
-        G, nx.spring_layout, pos=node_positions, fixed=node_positions.keys()
-    )
+    # Nodes stay at their testbed positions, no layout has to be solved
+    positions = load_positions()
+    graph = from_networkx(G, {n: positions[n] for n in G if n in positions})
 
-    graph.node_renderer.glyph = Circle(size=15, fill_color=Spectral4[0])
-    graph.node_renderer.selection_glyph = Circle(size=15, fill_color=Spectral4[2])
-    graph.node_renderer.hover_glyph = Circle(size=15, fill_color=Spectral4[1])
+    graph.node_renderer.glyph = Scatter(size=15, fill_color=Spectral4[0])
+    graph.node_renderer.selection_glyph = Scatter(size=15, fill_color=Spectral4[2])
+    graph.node_renderer.hover_glyph = Scatter(size=15, fill_color=Spectral4[1])
 
     graph.edge_renderer.glyph = MultiLine(
         line_color="#CCCCCC", line_alpha=0.8, line_width=5
@@ -85,3 +106,141 @@ def draw_graph(plot, G):
 
     plot.renderers.append(graph)
     return plot
+
+
+def pair_matrix(
+    df: pd.DataFrame, by="Kernel", value: str = "Throughput [Mbps]"
+) -> pd.DataFrame:
+    """Mean of `value` for every (AP, STA) pair, computed once per selection.
+
+    Args:
+        df (pd.DataFrame): intervals, e.g. from `analysis.get_iperf_folder`
+        by (str or list): column(s) to select by on the map, e.g. `"Kernel"`
+            or `["Run", "Kernel"]`
+
+    Returns:
+        pd.DataFrame: one row per `by` value, one column per (AP, STA) pair
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    return (
+        df.groupby(by + ["Access Point", "Client"], observed=True)[value]
+        .mean()
+        .unstack(["Access Point", "Client"])
+    )
+
+
+class LinkMap:
+    """Map of all measured links, coloured by throughput.
+
+    Edge coordinates are computed once from the node positions, a link from
+    AP to STA is drawn shifted to the left of the line between them so that
+    both directions are visible. Throughput of every row of the pair matrix
+    is kept in the data source, switching between them (`select` or the
+    `widget`) only replaces the `throughput` column.
+
+    Args:
+        matrix (pd.DataFrame): output of `pair_matrix`
+        offset (float): distance between the two directions of a link (in m)
+        palette (list): colours from lowest to highest throughput
+    """
+
+    def __init__(self, matrix: pd.DataFrame, offset=0.15, palette=Viridis256):
+        positions = load_nodes()[["x", "y"]]
+        pairs = matrix.columns[
+            matrix.columns.get_level_values(0).isin(positions.index)
+            & matrix.columns.get_level_values(1).isin(positions.index)
+        ]
+        self.matrix = matrix[pairs]
+        self.keys = list(self.matrix.index)
+        self.labels = [
+            " ".join(map(str, key)) if isinstance(key, tuple) else str(key)
+            for key in self.keys
+        ]
+
+        start = positions.loc[pairs.get_level_values(0)].to_numpy(dtype=float)
+        end = positions.loc[pairs.get_level_values(1)].to_numpy(dtype=float)
+        direction = end - start
+        length = np.hypot(direction[:, 0], direction[:, 1])[:, None]
+        shift = direction[:, ::-1] * [-0.5 * offset, 0.5 * offset]
+        shift = shift / np.where(length > 0, length, 1)
+        start, end = start + shift, end + shift
+
+        values = self.matrix.to_numpy(dtype=float)
+        data = {
+            "xs": list(np.stack([start[:, 0], end[:, 0]], axis=1)),
+            "ys": list(np.stack([start[:, 1], end[:, 1]], axis=1)),
+            "ap": list(pairs.get_level_values(0)),
+            "sta": list(pairs.get_level_values(1)),
+            "throughput": values[0] if len(values) else np.full(len(pairs), np.nan),
+        }
+        for i, row in enumerate(values):
+            data[f"value{i}"] = row
+        self.source = ColumnDataSource(data)
+        self.palette = palette
+        self.low = np.nanmin(values) if np.isfinite(values).any() else 0
+        self.high = np.nanmax(values) if np.isfinite(values).any() else 1
+        self.key = self.keys[0] if self.keys else None
+
+    def select(self, key):
+        """Shows throughput of `key` (a row of the matrix)
+
+        In a notebook, call `push_notebook` afterwards to update the shown plot.
+        """
+        i = self.keys.index(key)
+        self.source.data["throughput"] = self.source.data[f"value{i}"]
+        self.key = key
+
+    def draw(self, plot=None):
+        """Draws the links and nodes, on a new map unless `plot` is given"""
+        if plot is None:
+            plot = create_map()
+        mapper = linear_cmap(
+            "throughput", self.palette, self.low, self.high, nan_color="#00000000"
+        )
+        links = plot.multi_line(
+            xs="xs", ys="ys", source=self.source, line_color=mapper, line_width=3
+        )
+        plot.add_tools(
+            HoverTool(
+                renderers=[links],
+                tooltips=[
+                    ("AP", "@ap"),
+                    ("STA", "@sta"),
+                    ("Throughput [Mbps]", "@throughput{0.0}"),
+                ],
+            )
+        )
+        plot.add_layout(ColorBar(color_mapper=mapper["transform"]), "right")
+
+        nodes = load_nodes()
+        plot.scatter(
+            x=nodes["x"].to_numpy(),
+            y=nodes["y"].to_numpy(),
+            size=10,
+            fill_color=Spectral4[0],
+        )
+        return plot
+
+    def widget(self):
+        """Returns selection of the matrix row, switching in the browser"""
+        select = Select(
+            title=self.matrix.index.name or ", ".join(self.matrix.index.names),
+            value=self.labels[self.keys.index(self.key)],
+            options=self.labels,
+        )
+        select.js_on_change(
+            "value",
+            CustomJS(
+                args={"source": self.source, "labels": self.labels},
+                code="""
+                const i = labels.indexOf(cb_obj.value)
+                source.data.throughput = source.data["value" + i]
+                source.change.emit()
+                """,
+            ),
+        )
+        return select
+
+    def layout(self, plot=None):
+        """Returns the map with the selection widget above it"""
+        return column(self.widget(), self.draw(plot), sizing_mode="scale_width")
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+import click
+import experiment
+import json
+import random
+import re
+import tempfile
+import time
+import tracing
+import wifi
+
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+from pathlib import Path
+
+
+class FakeConnection:
+    """In-process stand-in for a fabric `Connection` to a testbed node.
+
+    Answers the commands issued by `wifi`, `measurement` and `experiment`
+    from a small model of the node (wireless devices, interfaces, daemons and
+    uploaded files). Every call sleeps `latency` seconds to model the SSH
+    round trip and is recorded in `tracing.tracer`.
+
+    Args:
+        host (str): node name
+        latency (float): round trip time (in seconds)
+        measure_time (float): time iperf3 client takes (in seconds)
+        json_stream (bool): iperf3 supports `--json-stream`
+    """
+
+    def __init__(self, host, latency=0.02, measure_time=0.0, json_stream=True):
+        self.host = host
+        self.latency = latency
+        self.measure_time = measure_time
+        self.json_stream = json_stream
+        self.round_trips = 0
+        self.phys = {"phy0": "0000:02:00.0", "phy1": "0000:03:00.0"}
+        self.interfaces = {}
+        self.daemons = []
+        self.files = {}
+        self.interrupted = False
+        self.handlers = [
+            (r"^pkill -INT -x iperf3", self._interrupt),
+            (r"^ls -alh /sys/class/ieee80211/", self._topology),
+            (r"^iw dev (\S+) info", self._iface_info),
+            (r"^iw (\S+) interface add (\S+)", self._iface_add),
+            (r"^iw (\S+) del", self._iface_del),
+            (r'^pkill -f "(.*)"', self._pkill),
+            (r"^sh -c 'for i in (.*); do iw dev \$i scan", self._scan),
+            (r"^sh -c 'end=", self._wait),
+            (r"^hostapd .* -P /tmp/hostapd-(\S+)\.pid", self._daemon),
+            (r"^wpa_supplicant .* -P /tmp/wpasup-(\S+)\.pid", self._daemon),
+            (r"^sha256sum (\S+)", self._sha256sum),
+            (r"^iperf3 --help", self._iperf_help),
+            (r"(?:^|; )iperf3 --client", self._iperf_client),
+            (r"^findmnt", lambda cmd, match: "/dev/mapper/vg-root\n"),
+        ]
+
+    def run(self, command, warn=False, out_stream=None, **kwargs):
+        with tracing.tracer.span(self.host, command):
+            self.round_trips += 1
+            time.sleep(self.latency)
+            stdout, exited = "", 0
+            for pattern, handler in self.handlers:
+                match = re.search(pattern, command)
+                if match:
+                    answer = handler(command, match)
+                    if not isinstance(answer, tuple):
+                        answer = (answer, 0)
+                    stdout, exited = answer
+                    break
+            if out_stream is not None:
+                self.interrupted = False
+                for line in stdout.splitlines(keepends=True):
+                    if self.interrupted:
+                        break
+                    out_stream.write(line)
+            result = Result(stdout=stdout, command=command, exited=exited)
+            if exited and not warn:
+                raise UnexpectedExit(result)
+            return result
+
+    def sudo(self, command, **kwargs):
+        return self.run(command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        with tracing.tracer.span(self.host, f"put {remote}"):
+            self.round_trips += 1
+            time.sleep(self.latency)
+            self.files[remote] = local.getvalue()
+
+    def _interrupt(self, command, match):
+        self.interrupted = True
+        return ""
+
+    def _topology(self, command, match):
+        lines = [
+            f"lrwxrwxrwx 1 root root 0 Jan 17 14:41 {phy} ->"
+            f" ../../devices/pci0000:00/0000:00:1c.0/{bus}/ieee80211/{phy}"
+            for phy, bus in self.phys.items()
+        ]
+        lines.append("---")
+        for phy in self.phys:
+            lines.append(f"phy#{phy[3:]}")
+            for iface, iface_phy in self.interfaces.items():
+                if iface_phy == phy:
+                    lines.append(f"\tInterface {iface}")
+        return "\n".join(lines) + "\n"
+
+    def _iface_info(self, command, match):
+        if match.group(1) not in self.interfaces:
+            return "", 237
+        phy = self.interfaces[match.group(1)]
+        return f"Interface {match.group(1)}\n\twiphy {phy[3:]}\n"
+
+    def _iface_add(self, command, match):
+        self.interfaces[match.group(2)] = match.group(1)
+        return ""
+
+    def _iface_del(self, command, match):
+        self.interfaces.pop(match.group(1), None)
+        return ""
+
+    def _pkill(self, command, match):
+        killed = [cmd for cmd in self.daemons if re.search(match.group(1), cmd)]
+        self.daemons = [cmd for cmd in self.daemons if cmd not in killed]
+        return "", 0 if killed else 1
+
+    def _wait(self, command, match):
+        if "wpa_state=COMPLETED" not in command:
+            return ""
+        iface = re.search(r"/run/wpasup-(\S+) ", command).group(1)
+        running = any(
+            cmd.startswith("wpa_supplicant") and f" -i {iface} " in cmd
+            for cmd in self.daemons
+        )
+        return "", 0 if running else 1
+
+    def _scan(self, command, match):
+        output = []
+        for iface in match.group(1).split():
+            for i in range(20):
+                channel = [1, 6, 11, 36, 40][i % 5]
+                freq = 2407 + 5 * channel if channel < 15 else 5000 + 5 * channel
+                output += [
+                    f"BSS 02:00:00:00:{i:02x}:{len(output) % 256:02x}(on {iface})",
+                    "\tTSF: 0 usec (0d, 00:00:00)",
+                    f"\tfreq: {freq}",
+                    "\tbeacon interval: 100 TUs",
+                    f"\tsignal: {random.uniform(-90, -30):.2f} dBm",
+                    f"\tSSID: net{i}",
+                ]
+        return "\n".join(output) + "\n"
+
+    def _daemon(self, command, match):
+        self.daemons.append(command)
+        return ""
+
+    def _sha256sum(self, command, match):
+        if match.group(1) not in self.files:
+            return "", 1
+        content = self.files[match.group(1)].encode("utf-8")
+        return f"{wifi.sha256(content).hexdigest()}  {match.group(1)}\n"
+
+    def _iperf_help(self, command, match):
+        if not self.json_stream:
+            return ""
+        return "  --json-stream  output in line-delimited JSON format\n"
+
+    def _iperf_client(self, command, match):
+        start_at = re.search(r"sleep \$\(awk -v t=([\d.]+)", command)
+        if start_at:
+            time.sleep(max(0, float(start_at.group(1)) - time.time()))
+        time.sleep(self.measure_time)
+        title = re.search(r'--title "([^"]*)"', command)
+        duration = int(re.search(r"-t (\d+)", command).group(1))
+        start = {
+            "system_info": f"Linux {self.host} 4.14.5-041405-generic #1 SMP x86_64",
+            "timestamp": {"time": "Wed, 17 Jan 2018 14:42:17 GMT"},
+            "test_start": {"protocol": "UDP"},
+        }
+        intervals = []
+        for second in range(duration):
+            bits_per_second = random.gauss(2e7, 2e6)
+            stream = {
+                "socket": 4,
+                "start": second,
+                "end": second + 1,
+                "seconds": 1,
+                "bytes": int(bits_per_second / 8),
+                "bits_per_second": bits_per_second,
+                "packets": 300,
+                "omitted": False,
+            }
+            intervals.append({"streams": [stream], "sum": stream})
+        end = {"sum": {"bits_per_second": 2e7}}
+        if "--json-stream" not in command:
+            return json.dumps(
+                {
+                    "title": title.group(1) if title else "",
+                    "start": start,
+                    "intervals": intervals,
+                    "end": end,
+                }
+            )
+        events = [{"event": "start", "data": start}]
+        events += [{"event": "interval", "data": x} for x in intervals]
+        events.append({"event": "end", "data": end})
+        return "".join(json.dumps(event) + "\n" for event in events)
+
+
+def measuring_time(spans):
+    """Returns wall time (in seconds) during which any iperf3 client ran"""
+    total, end = 0.0, 0.0
+    clients = [s for s in spans if s.command.startswith("iperf3 --client")]
+    for span in sorted(clients, key=lambda s: s.start):
+        stop = span.start + span.duration
+        if stop > end:
+            total += stop - max(span.start, end)
+            end = stop
+    return total
+
+
+def fake_nodes(count, latency, measure_time, json_stream):
+    return [
+        FakeConnection(f"nuc{i}", latency, measure_time, json_stream)
+        for i in range(count)
+    ]
+
+
+def bench_create_ap(grp, data_folder):
+    for node in grp:
+        wifi.create_ap(node, phy="02:00")
+    return len(grp)
+
+
+def bench_connect(grp, data_folder):
+    for node in grp:
+        wifi.connect(node, phy="02:00")
+    return len(grp)
+
+
+def bench_phy_clean(grp, data_folder):
+    for node in grp:
+        wifi.phy_clean(node, phy="02:00")
+    return len(grp)
+
+
+def bench_campaign(**kwargs):
+    def bench(grp, data_folder):
+        progress = experiment.campaign(grp, data_folder, duration=120, **kwargs)
+        return len(progress.pairs)
+
+    return bench
+
+
+# Scenarios not starting from a clean node, with their preparation
+PREPARE = {"phy_clean": bench_create_ap}
+
+
+def bench_multi(grp, data_folder):
+    for ap, stations in experiment.select_one(grp):
+        experiment.measure_clients(
+            ap, stations, "02:00", 10, data_folder, start_delay=0.5
+        )
+    return len(grp) * (len(grp) - 1)
+
+
+def bench_survey(grp, data_folder):
+    experiment.scan_survey(grp, data_folder / "survey.arrows", interval=0, count=5)
+    return len(grp) * 5
+
+
+SCENARIOS = {
+    "create_ap": bench_create_ap,
+    "connect": bench_connect,
+    "phy_clean": bench_phy_clean,
+    "run": bench_campaign(),
+    "run-warm": bench_campaign(warm=True),
+    "run-parallel": bench_campaign(parallel=True),
+    "run-adaptive": bench_campaign(ci_width=0.05, min_duration=5),
+    "multi": bench_multi,
+    "survey": bench_survey,
+}
+
+
+@click.command(short_help="Benchmark orchestration overhead against fake nodes")
+@click.option("--nodes", "-n", default=6, help="Number of fake nodes")
+@click.option("--latency", "-l", default=0.02, help="SSH round trip time (in seconds)")
+@click.option(
+    "--measure-time", default=0.0, help="Time of each iperf3 measurement (in seconds)"
+)
+@click.option(
+    "--json-stream/--no-json-stream",
+    default=True,
+    help="Fake iperf3 supports --json-stream",
+)
+@click.option(
+    "--scenario",
+    "-s",
+    type=click.Choice(list(SCENARIOS)),
+    multiple=True,
+    help="Scenarios to run (all if not given)",
+)
+def cli(nodes, latency, measure_time, json_stream, scenario):
+    click.echo(
+        f"{'scenario':<14} {'units':>6} {'round trips/unit':>17}"
+        f" {'overhead/unit [s]':>18}"
+    )
+    spans = []
+    for name in scenario or SCENARIOS:
+        grp = fake_nodes(nodes, latency, measure_time, json_stream)
+        with tempfile.TemporaryDirectory() as data_folder:
+            if name in PREPARE:
+                PREPARE[name](grp, Path(data_folder))
+            tracing.tracer.spans = []
+            t_start = time.perf_counter()
+            units = SCENARIOS[name](grp, Path(data_folder))
+            elapsed = time.perf_counter() - t_start
+        # Time spent in (fake) measurements is not orchestration overhead
+        overhead = elapsed - measuring_time(tracing.tracer.spans)
+        round_trips = len(tracing.tracer.spans)
+        click.echo(
+            f"{name:<14} {units:>6} {round_trips / units:>17.1f}"
+            f" {overhead / units:>18.3f}"
+        )
+        spans += tracing.tracer.spans
+    # Phases of all scenarios together
+    tracing.tracer.spans = spans
+    click.echo(tracing.tracer.table())
+
+
+if __name__ == "__main__":
+    # pylint: disable=no-value-for-parameter
+    cli()
@@ -4,17 +4,30 @@ import sys
 import click
 import measurement
 import kernel
+import manifest
+import queue
+import schedule
+import threading
 import time
+import tracing
 import wifi
 import yaml
 import logging
+import random
+import socket
+import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
 from fabric import SerialGroup
 from fabric import Connection
+from invoke.exceptions import CommandTimedOut
 from pathlib import Path
 from pprint import pprint
+from survey import SurveyWriter
 from tqdm import tqdm
-from paramiko.ssh_exception import AuthenticationException, NoValidConnectionsError
+from paramiko.ssh_exception import AuthenticationException
+from paramiko.ssh_exception import NoValidConnectionsError
+from paramiko.ssh_exception import SSHException
 from socket import gaierror
 
 BASE_PATH = Path(__file__).absolute().parents[1]
@@ -35,45 +48,132 @@ def select_one(param):
         yield sel, cut
 
 
-def get_all_nodes(user=None, limit=None):
+def probe_node(host, user=None, timeout=10):
+    """Connects to `host` and checks that the experiment OS is booted.
+
+    Args:
+        host (str): node name
+        user (str): login user
+        timeout (int): connection timeout (in seconds)
+
+    Returns:
+        Connection: usable connection, None if the node cannot be used
+    """
+    try:
+        cnx = tracing.TracedConnection(
+            host,
+            user=user,
+            connect_timeout=timeout,
+            connect_kwargs={"banner_timeout": timeout, "auth_timeout": timeout},
+            # gateway=gateway,
+        )
+        result = cnx.run("findmnt / -o SOURCE", hide=True, timeout=timeout)
+        if "vg" not in result.stdout:
+            raise InterruptedError()
+        return cnx
+    except InterruptedError:
+        log.error(f"{host}: Wrong OS, boot the experiment")
+    except (
+        AuthenticationException,
+        NoValidConnectionsError,
+        SSHException,
+        gaierror,
+        socket.timeout,
+        CommandTimedOut,
+    ):
+        log.error(f"{host}: Cannot connect or login")
+
+
+def get_all_nodes(user=None, limit=None, timeout=10):
     with (BASE_PATH / "node_selection" / "hosts").open("r") as stream:
-        config = yaml.load(stream)
+        config = yaml.safe_load(stream)
     hosts = []
     for group in config:
         hosts.extend(config[group]["hosts"].keys())
     log.info(f"Node info: {hosts}")
-    grp = []
     if limit:
         hosts = [host for host in hosts if host in limit]
-    for host in hosts:
-        try:
-            cnx = Connection(
-                host,
-                user=user,
-                # gateway=gateway,
-            )
-            result = cnx.run("findmnt / -o SOURCE", hide=True)
-            if "vg" not in result.stdout:
-                raise InterruptedError()
-            grp.append(cnx)
-        except InterruptedError:
-            log.error(f"{host}: Wrong OS, boot the experiment")
-            continue
-        except (AuthenticationException, NoValidConnectionsError, gaierror):
-            log.error(f"{host}: Cannot connect or login")
-            continue
+    if not hosts:
+        return []
+    # Every probe is bounded by the connect, banner, auth and command timeouts
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = executor.map(lambda host: probe_node(host, user, timeout), hosts)
+        grp = [cnx for cnx in results if cnx is not None]
     log.info(f"Node info: {grp}")
     return grp
 
 
+def wait_down(host, timeout=120, interval=1, port=22):
+    """Waits until SSH port of `host` stops accepting connections
+
+    Returns:
+        bool: False if `timeout` expired
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=interval).close()
+        except OSError:
+            return True
+        time.sleep(interval)
+    return False
+
+
+def wait_ready(
+    host, release, user=None, timeout=600, connect_timeout=10, delay=5, max_delay=60
+):
+    """Waits until `host` runs the experiment OS with kernel `release`.
+
+    Nodes are polled with exponential backoff (with jitter, so many nodes
+    waited for at once do not poll in lockstep). State cached for the node
+    before the reboot (`wifi.forget`, `measurement.forget`) is dropped.
+
+    Args:
+        host (str): node name
+        release (str): expected kernel release (`uname -r`)
+        user (str): login user
+        timeout (float): maximum waiting time (in seconds)
+        connect_timeout (int): connection timeout of a single probe
+        delay (float): initial polling interval (in seconds)
+        max_delay (float): maximum polling interval (in seconds)
+
+    Returns:
+        Connection: usable connection, None if `timeout` expired
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, 22), timeout=connect_timeout).close()
+            cnx = probe_node(host, user, connect_timeout)
+            if cnx is not None:
+                running = kernel.release(cnx)
+                if running == release:
+                    # Connections compare equal across reboots, cached state
+                    # of the previous kernel must not be reused
+                    wifi.forget(cnx)
+                    measurement.forget(cnx)
+                    return cnx
+                log.info(f"{host}: Running {running}, waiting for {release}")
+        except OSError:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+        delay = min(delay * 2, max_delay)
+
+
 @click.group(context_settings=dict(help_option_names=["-h", "--help"], obj={}))
 @click.option("--user", "-u", default=None, help="Select user")
 @click.option(
     "-v", "--verbose", count=True, help="Increase log verbosity level (up to 4)"
 )
+@click.option(
+    "--timeout", default=10, help="Node discovery timeout per host (in seconds)"
+)
 @click.version_option("v1.0.1")
 @click.pass_context
-def cli(ctx, user, verbose):
+def cli(ctx, user, verbose, timeout):
     level = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
     if verbose < 3:
         log.setLevel(level[verbose])
@@ -88,6 +188,261 @@ def cli(ctx, user, verbose):
     )
 
     ctx.obj["user"] = user
+    ctx.obj["timeout"] = timeout
+
+
+def report_throughput(pbar, key, postfix):
+    """Returns iperf3 interval callback showing current throughput in `pbar`
+
+    Args:
+        pbar (tqdm): progress bar
+        key (str): postfix entry of this measurement
+        postfix (dict): postfix shared by all measurements shown in `pbar`
+    """
+
+    def on_interval(interval):
+        postfix[key] = f"{interval['bits_per_second'] * 1e-6:.1f}M"
+        pbar.set_postfix(postfix)
+
+    return on_interval
+
+
+def measure(
+    sta,
+    ap,
+    phy,
+    duration,
+    result_path,
+    ip="10.1.1.1",
+    stream=True,
+    concurrency=None,
+    ci_width=None,
+    min_duration=10,
+    **kw,
+):
+    """Runs iperf3 client on `sta` and stores the result in `result_path`.
+
+    Args:
+        sta (Connection): station running the iperf3 client
+        ap (Connection): access point running the iperf3 server
+        phy (str): Physical device. Either name or PCI bus
+        duration (int): Iperf3 measurement duration, maximum duration if
+            `ci_width` is given
+        result_path (Path): local result file
+        ip (str): IP address of the AP
+        stream (bool): write iperf3 intervals while the test runs
+        concurrency (int): number of stations measured at the same time
+        ci_width (float): stop once the confidence interval of the mean
+            throughput is within this relative width (requires `stream`)
+        min_duration (int): minimum duration of adaptive measurements
+        kw: additional arguments for `measurement.iperf_client`
+
+    Returns:
+        dict: stopping reason and measured seconds of an adaptive measurement,
+        to be stored in the manifest (empty for fixed duration)
+    """
+    title = f"AP {ap.host} STA {sta.host} using phy {phy}"
+    if concurrency is not None:
+        title += f" concurrency {concurrency}"
+    with tracing.tracer.phase("measure"):
+        if stream:
+            convergence = None
+            if ci_width is not None:
+                convergence = measurement.Convergence(min_duration, duration, ci_width)
+            measurement.iperf_client(
+                sta,
+                ip=ip,
+                duration=duration,
+                title=title,
+                stream_to=result_path,
+                convergence=convergence,
+                **kw,
+            )
+            if convergence is None or convergence.reason is None:
+                return {}
+            return {"stop": convergence.reason, "seconds": convergence.count}
+        kw.pop("on_interval", None)
+        result = measurement.iperf_client(
+            sta, ip=ip, duration=duration, title=title, **kw
+        )
+    with result_path.open("w") as f:
+        f.write(result.stdout)
+    return {}
+
+
+def measure_pair(
+    assignment,
+    phy,
+    duration,
+    data_folder,
+    stream=True,
+    on_interval=None,
+    assoc_timeout=10,
+    **kw,
+):
+    """Measures one (AP, STA) pair on its own channel, SSID and subnet.
+
+    Args:
+        assignment (schedule.Assignment): pair and its radio configuration
+        phy (str): Physical device. Either name or PCI bus
+        duration (int): Iperf3 measurement duration
+        data_folder (Path): folder to store measurement in
+        stream (bool): write iperf3 intervals while the test runs
+        on_interval (callable): called with every streamed iperf3 interval
+        assoc_timeout (float): maximum association time (in seconds)
+        kw: additional arguments for `measure`
+
+    Returns:
+        dict: setup latency (in seconds) and `measure` output to be stored in
+        the manifest, None if the station could not connect
+    """
+    ap, sta, channel, ssid, subnet = assignment
+    ap_ip = f"{subnet}.1"
+    try:
+        t_start = time.perf_counter()
+        wifi.create_ap(ap, phy=phy, ssid=ssid, channel=channel, ip=ap_ip)
+        measurement.iperf_server(ap)
+        try:
+            wifi.connect(
+                sta,
+                phy=phy,
+                ssid=ssid,
+                ip=wifi.generate_ip(sta, subnet=subnet),
+                timeout=assoc_timeout,
+            )
+        except EnvironmentError:
+            log.warning(f"Could not connect {sta.host} to {ap.host}")
+            return None
+        setup = time.perf_counter() - t_start
+        log.info(f"Setup {ap.host} -> {sta.host}: {setup:.2f} s")
+        info = measure(
+            sta,
+            ap,
+            phy,
+            duration,
+            data_folder / f"{ap.host}-{sta.host}.json",
+            ip=ap_ip,
+            stream=stream,
+            on_interval=on_interval,
+            **kw,
+        )
+        return dict(setup=round(setup, 3), **info)
+    finally:
+        with tracing.tracer.phase("teardown"):
+            wifi.phy_clean(sta, phy=phy)
+            wifi.phy_clean(ap, phy=phy)
+            measurement.iperf_kill(ap)
+
+
+def measure_clients(
+    ap,
+    stations,
+    phy,
+    duration,
+    data_folder,
+    channel=6,
+    stream=True,
+    assoc_timeout=10,
+    start_delay=2,
+    on_interval=None,
+):
+    """Measures all `stations` against `ap` at the same time.
+
+    The AP runs one iperf3 server per station. Stations connect
+    concurrently and their clients start together at a common time.
+
+    Args:
+        ap (Connection): access point running the iperf3 servers
+        stations (list): stations running the iperf3 clients
+        phy (str): Physical device. Either name or PCI bus
+        duration (int): Iperf3 measurement duration
+        data_folder (Path): folder to store measurements in
+        channel (int): Used channel
+        stream (bool): write iperf3 intervals while the test runs
+        assoc_timeout (float): maximum association time (in seconds)
+        start_delay (float): time between issuing and starting the clients
+            (in seconds), must cover the SSH latency to all stations
+        on_interval (callable): called with station host name and every
+            streamed iperf3 interval
+
+    Returns:
+        dict: station host name to its mean throughput (in bit/s), for the
+        stations that could connect
+    """
+    try:
+        wifi.create_ap(ap, phy=phy, ssid="tkn_walker", channel=channel)
+        ports = measurement.iperf_servers(ap, len(stations))
+        with ThreadPoolExecutor(max_workers=len(stations)) as executor:
+            futures = [
+                executor.submit(
+                    wifi.connect,
+                    sta,
+                    phy=phy,
+                    ssid="tkn_walker",
+                    ip=f"10.1.1.{i + 10}",
+                    timeout=assoc_timeout,
+                )
+                for i, sta in enumerate(stations)
+            ]
+            connected = []
+            for sta, port, future in zip(stations, ports, futures):
+                try:
+                    future.result()
+                    connected.append((sta, port))
+                except EnvironmentError:
+                    log.warning(f"Could not connect {sta.host} to {ap.host}")
+        if not connected:
+            return {}
+
+        samples = {sta.host: [] for sta, _ in connected}
+
+        def collect(host):
+            def on_sample(interval):
+                samples[host].append(interval["bits_per_second"])
+                if on_interval is not None:
+                    on_interval(host, interval)
+
+            return on_sample
+
+        paths = {
+            sta.host: data_folder / f"{ap.host}-{sta.host}-x{len(connected)}.json"
+            for sta, _ in connected
+        }
+        start_at = time.time() + start_delay
+        with ThreadPoolExecutor(max_workers=len(connected)) as executor:
+            futures = [
+                executor.submit(
+                    measure,
+                    sta,
+                    ap,
+                    phy,
+                    duration,
+                    paths[sta.host],
+                    stream=stream,
+                    concurrency=len(connected),
+                    port=port,
+                    start_at=start_at,
+                    on_interval=collect(sta.host),
+                )
+                for sta, port in connected
+            ]
+            for future in futures:
+                future.result()
+        throughput = {}
+        for host, values in samples.items():
+            if values:
+                throughput[host] = sum(values) / len(values)
+            else:
+                # No streamed intervals (old iperf3 or `stream` off)
+                mean = measurement.result_throughput(paths[host])
+                throughput[host] = float("nan") if mean is None else mean
+        return throughput
+    finally:
+        with tracing.tracer.phase("teardown"):
+            with ThreadPoolExecutor(max_workers=len(stations)) as executor:
+                list(executor.map(lambda sta: wifi.phy_clean(sta, phy=phy), stations))
+            wifi.phy_clean(ap, phy=phy)
+            measurement.iperf_kill(ap)
 
 
 @cli.command(short_help="Scan for networks")
@@ -99,6 +454,104 @@ def scan():
         pprint(wifi.scan(sta, phy="02:00"))
 
 
+@cli.command(short_help="Survey networks from all nodes and phys, repeatedly")
+@click.option(
+    "--interval", "-i", default=10.0, help="Time between scans of a node (in seconds)"
+)
+@click.option("--count", "-n", default=0, help="Number of scans (0: until interrupted)")
+@click.option("--limit", "-l", help="Limit target hosts to comma separated list")
+@click.option(
+    "--output", "-o", type=click.Path(dir_okay=False), help="Output file (.arrows)"
+)
+@click.option(
+    "--flush", default=5.0, help="Time between writes to the output (in seconds)"
+)
+@click.pass_context
+def survey(ctx, interval, count, limit, output, flush):
+    if limit is not None:
+        limit = limit.split(",")
+    grp = get_all_nodes(ctx.obj["user"], limit, ctx.obj["timeout"])
+    if not grp:
+        return
+    if output is None:
+        output = BASE_PATH / "data" / time.strftime("survey-%Y-%m-%d-%H%M%S.arrows")
+        output.parent.mkdir(parents=True, exist_ok=True)
+    log.info(f"Storing survey in {output}")
+    scan_survey(grp, Path(output), interval, count, flush)
+
+
+def scan_survey(grp, output, interval=10.0, count=0, flush=5.0):
+    """Scans from all phys of all nodes concurrently and repeatedly.
+
+    Every node scans on its own schedule, the networks seen are appended to
+    `output` every `flush` seconds (see `survey.SurveyWriter`).
+
+    Args:
+        grp (list): scanning nodes
+        output (Path): output file
+        interval (float): time between scans of a node (in seconds)
+        count (int): number of scans per node, 0 to scan until interrupted
+        flush (float): time between writes to `output` (in seconds)
+    """
+    with ThreadPoolExecutor(max_workers=len(grp)) as executor:
+        devices = list(executor.map(wifi.scan_setup, grp))
+
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def scan_node(node, node_devices):
+        scans = 0
+        while not stop.is_set() and (not count or scans < count):
+            t_start = time.time()
+            try:
+                results.put((time.time(), wifi.scan_all(node, node_devices)))
+            except Exception as e:
+                log.warning(f"{node.host}: Scan failed ({e})")
+            scans += 1
+            stop.wait(max(0.0, interval - (time.time() - t_start)))
+
+    threads = [
+        threading.Thread(target=scan_node, args=(node, node_devices), daemon=True)
+        for node, node_devices in zip(grp, devices)
+    ]
+    for thread in threads:
+        thread.start()
+
+    writer = SurveyWriter(output)
+    pbar = tqdm(total=count * len(grp) or None, unit="scan", dynamic_ncols=True)
+    times, networks = [], []
+    last_write = time.monotonic()
+    try:
+        while any(thread.is_alive() for thread in threads) or not results.empty():
+            try:
+                scan_time, scan_networks = results.get(timeout=0.5)
+                times.extend([scan_time] * len(scan_networks))
+                networks.extend(scan_networks)
+                pbar.update()
+                pbar.set_postfix(networks=len(scan_networks))
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_write >= flush:
+                writer.write(times, networks)
+                times, networks = [], []
+                last_write = time.monotonic()
+    except KeyboardInterrupt:
+        log.info("Stopping survey")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        while not results.empty():
+            scan_time, scan_networks = results.get()
+            times.extend([scan_time] * len(scan_networks))
+            networks.extend(scan_networks)
+        writer.write(times, networks)
+        writer.close()
+        pbar.close()
+        with ThreadPoolExecutor(max_workers=len(grp)) as executor:
+            list(executor.map(wifi.phy_clean, grp))
+
+
 @cli.command(short_help="Run short test between two nodes")
 @click.option("--duration", "-d", default=60, help="Iperf3 measurement duration")
 @click.option(
@@ -120,8 +573,8 @@ def scan():
 @click.option("--channel", default=6, help="Wifi channel to use")
 @click.pass_context
 def short(ctx, duration, access_point, client, traffic, channel):
-    ap = Connection(access_point, user=ctx.obj["user"], gateway=gateway)
-    sta = Connection(client, user=ctx.obj["user"], gateway=gateway)
+    ap = tracing.TracedConnection(access_point, user=ctx.obj["user"], gateway=gateway)
+    sta = tracing.TracedConnection(client, user=ctx.obj["user"], gateway=gateway)
     phy = "02:00"
 
     for host in [ap, sta]:
@@ -162,59 +615,331 @@ def short(ctx, duration, access_point, client, traffic, channel):
 @click.option("--duration", "-d", default=60, help="Iperf3 measurement duration")
 @click.option("--channel", "-c", default=6, help="Wifi channel to use")
 @click.option("--limit", "-l", help="Limit target hosts to comma separated list")
+@click.option(
+    "--parallel",
+    "-p",
+    is_flag=True,
+    help="Measure pairs without common nodes at the same time on separate channels",
+)
+@click.option(
+    "--stream/--no-stream",
+    default=True,
+    help="Write iperf3 intervals to disk while the test runs",
+)
+@click.option(
+    "--resume",
+    "-r",
+    type=click.Path(exists=True, file_okay=False),
+    help="Continue interrupted campaign stored in given data folder",
+)
+@click.option(
+    "--assoc-timeout", default=10.0, help="Maximum association time (in seconds)"
+)
+@click.option(
+    "--warm",
+    "-w",
+    is_flag=True,
+    help="Keep stations and their supplicant up, only re-associate per pair",
+)
+@click.option(
+    "--ci-width",
+    type=float,
+    help="Stop once the confidence interval of the mean throughput is within "
+    "this relative width, e.g. 0.05 (--duration is then the maximum)",
+)
+@click.option(
+    "--min-duration", default=10, help="Minimum duration of adaptive measurements"
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False),
+    help="Export remote commands as Chrome trace JSON to given file",
+)
 @click.pass_context
-def run(ctx, duration, channel, limit):
+def run(
+    ctx,
+    duration,
+    channel,
+    limit,
+    parallel,
+    stream,
+    resume,
+    assoc_timeout,
+    warm,
+    ci_width,
+    min_duration,
+    trace,
+):
     if limit is not None:
         limit = limit.split(",")
-    grp = get_all_nodes(ctx.obj["user"], limit)
-    phy = "02:00"
-    data_folder = BASE_PATH / "data" / time.strftime("%Y-%m-%d-%H%M%S")
-    data_folder.mkdir(parents=True)
+    grp = get_all_nodes(ctx.obj["user"], limit, ctx.obj["timeout"])
+    if resume is None:
+        data_folder = BASE_PATH / "data" / time.strftime("%Y-%m-%d-%H%M%S")
+        data_folder.mkdir(parents=True)
+    else:
+        data_folder = Path(resume).absolute()
     log.info(f"Storing measurements in {data_folder}")
+    progress = campaign(
+        grp,
+        data_folder,
+        duration=duration,
+        channel=channel,
+        parallel=parallel,
+        stream=stream,
+        assoc_timeout=assoc_timeout,
+        warm=warm,
+        ci_width=ci_width,
+        min_duration=min_duration,
+    )
+    report(progress, trace, duration if ci_width is not None else None)
+
+
+def campaign(
+    grp,
+    data_folder,
+    duration=60,
+    channel=6,
+    parallel=False,
+    stream=True,
+    assoc_timeout=10,
+    warm=False,
+    ci_width=None,
+    min_duration=10,
+    phy="02:00",
+):
+    """Measures all pending ordered pairs of `grp` (see `run` options)
+
+    Args:
+        grp (list): nodes taking part in the experiment
+        data_folder (Path): folder with results and campaign manifest
+
+    Returns:
+        manifest.Manifest: campaign progress
+    """
+    progress = manifest.Manifest(
+        data_folder, [(ap.host, sta.host) for ap, sta in schedule.pairs(grp)]
+    )
+    log.info(f"Campaign progress: {progress.summary()}")
     for host in grp:
         wifi.phy_clean(host)
         measurement.iperf_kill(host)
 
+    if parallel and warm:
+        log.warning("Warm stations are not supported in parallel mode")
+    if ci_width is not None and not stream:
+        log.warning("Adaptive duration requires streaming, using fixed duration")
+    adaptive = dict(ci_width=ci_width, min_duration=min_duration)
+
+    if parallel:
+        channels = [channel] + [ch for ch in schedule.CHANNELS if ch != channel]
+        pending = [
+            (ap, sta)
+            for ap, sta in schedule.pairs(grp)
+            if progress.pending(ap.host, sta.host)
+        ]
+        pbar_slot = tqdm(schedule.slots(pending, channels), dynamic_ncols=True)
+        for slot in pbar_slot:
+            pbar_slot.set_description(
+                ", ".join(f"{a.ap.host}>{a.sta.host}" for a in slot)
+            )
+            with ThreadPoolExecutor(max_workers=len(slot)) as executor:
+                postfix = {}
+                futures = [
+                    executor.submit(
+                        measure_pair,
+                        a,
+                        phy,
+                        duration,
+                        data_folder,
+                        stream,
+                        report_throughput(pbar_slot, a.sta.host, postfix),
+                        assoc_timeout,
+                        **adaptive,
+                    )
+                    for a in slot
+                ]
+                for a, future in zip(slot, futures):
+                    info = future.result()
+                    if info is None:
+                        progress.update(a.ap.host, a.sta.host, manifest.FAILED)
+                    else:
+                        progress.update(a.ap.host, a.sta.host, **info)
+        return progress
+
+    # Stations kept connected between pairs in warm mode, host to WiFiDev
+    warm_sta = {}
     pbar_ap = tqdm(select_one(grp), total=len(grp), dynamic_ncols=True)
     for ap, stations in pbar_ap:
         pbar_ap.set_description(f"AP {ap.host}")
+        stations = [sta for sta in stations if progress.pending(ap.host, sta.host)]
+        if not stations:
+            continue
 
-        # Create AP
+        # Create AP (replaces the station interface of a warm node)
+        t_start = time.perf_counter()
+        warm_sta.pop(ap.host, None)
         wifi.create_ap(ap, phy=phy, ssid="tkn_walker", channel=channel)
         measurement.iperf_server(ap)
+        log.info(f"Setup AP {ap.host}: {time.perf_counter() - t_start:.2f} s")
 
         pbar_sta = tqdm(stations, dynamic_ncols=True)
         for sta in pbar_sta:
             pbar_sta.set_description(f"STA {sta.host}")
             # Connect and measure
+            t_start = time.perf_counter()
             try:
-                wifi.connect(sta, phy=phy, ssid="tkn_walker")
+                if sta.host in warm_sta:
+                    wifi.reassociate(
+                        sta, warm_sta[sta.host].interface, timeout=assoc_timeout
+                    )
+                else:
+                    dev = wifi.connect(
+                        sta, phy=phy, ssid="tkn_walker", timeout=assoc_timeout
+                    )
+                    if warm:
+                        warm_sta[sta.host] = dev
             except EnvironmentError:
+                warm_sta.pop(sta.host, None)
                 wifi.phy_clean(sta, phy=phy)
                 log.warning(f"Could not connect {sta.host} to {ap.host}")
+                progress.update(ap.host, sta.host, manifest.FAILED)
                 continue
-            result = measurement.iperf_client(
+            setup = time.perf_counter() - t_start
+            log.info(f"Setup {ap.host} -> {sta.host}: {setup:.2f} s")
+            # Collect measurement
+            info = measure(
                 sta,
-                duration=duration,
-                title=f"AP {ap.host} STA {sta.host} using phy {phy}",
+                ap,
+                phy,
+                duration,
+                progress.result_path(ap.host, sta.host),
+                stream=stream,
+                on_interval=report_throughput(pbar_sta, "throughput", {}),
+                **adaptive,
             )
+            progress.update(ap.host, sta.host, setup=round(setup, 3), **info)
 
-            # Collect measurement
-            result_path = data_folder / f"{ap.host}-{sta.host}.json"
-            with result_path.open("w") as f:
-                f.write(result.stdout)
+            with tracing.tracer.phase("teardown"):
+                if sta.host in warm_sta:
+                    wifi.disconnect(sta, warm_sta[sta.host].interface)
+                else:
+                    wifi.phy_clean(sta, phy=phy)
 
-            wifi.phy_clean(sta, phy=phy)
+        with tracing.tracer.phase("teardown"):
+            wifi.phy_clean(ap, phy=phy)
+            measurement.iperf_kill(ap)
+    with tracing.tracer.phase("teardown"):
+        for sta in grp:
+            if sta.host in warm_sta:
+                wifi.phy_clean(sta, phy=phy)
+    return progress
+
+
+def report(progress, trace=None, duration=None):
+    """Prints campaign progress, setup latency and remote command summary
+
+    Args:
+        progress (manifest.Manifest): campaign progress
+        trace (str): file to export remote command trace to
+        duration (int): maximum measurement duration, to report time saved by
+            adaptive measurements
+    """
+    log.info(f"Campaign progress: {progress.summary()}")
+    log.info(f"Mean setup latency: {progress.mean_setup():.2f} s")
+    if duration is not None:
+        saved = progress.time_saved(duration)
+        click.echo(f"Time saved by adaptive duration: {saved} s")
+    report_commands(trace)
+
+
+def report_commands(trace=None):
+    """Prints remote command summary and exports the trace
 
-        wifi.phy_clean(ap, phy=phy)
-        measurement.iperf_kill(ap)
+    Args:
+        trace (str): file to export remote command trace to
+    """
+    click.echo(tracing.tracer.table())
+    if trace is not None:
+        tracing.tracer.export_chrome(Path(trace))
+        log.info(f"Remote command trace written to {trace}")
+
+
+@cli.command(short_help="Run experiment with concurrent stations")
+@click.option("--duration", "-d", default=60, help="Iperf3 measurement duration")
+@click.option("--channel", "-c", default=6, help="Wifi channel to use")
+@click.option("--limit", "-l", help="Limit target hosts to comma separated list")
+@click.option(
+    "--clients",
+    "-n",
+    type=click.IntRange(1, None),
+    multiple=True,
+    help="Number of concurrent stations, can be repeated (default: all other nodes)",
+)
+@click.option(
+    "--stream/--no-stream",
+    default=True,
+    help="Write iperf3 intervals to disk while the test runs",
+)
+@click.option(
+    "--assoc-timeout", default=10.0, help="Maximum association time (in seconds)"
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False),
+    help="Export remote commands as Chrome trace JSON to given file",
+)
+@click.pass_context
+def multi(ctx, duration, channel, limit, clients, stream, assoc_timeout, trace):
+    if limit is not None:
+        limit = limit.split(",")
+    grp = get_all_nodes(ctx.obj["user"], limit, ctx.obj["timeout"])
+    if len(grp) < 2:
+        raise click.ClickException("At least two nodes are needed")
+    data_folder = BASE_PATH / "data" / time.strftime("%Y-%m-%d-%H%M%S")
+    data_folder.mkdir(parents=True)
+    log.info(f"Storing measurements in {data_folder}")
+    for host in grp:
+        wifi.phy_clean(host)
+        measurement.iperf_kill(host)
+
+    levels = sorted(set(clients or [len(grp) - 1]))
+    rows = []
+    pbar = tqdm(
+        [(ap, n) for ap, _ in select_one(grp) for n in levels], dynamic_ncols=True
+    )
+    for ap, count in pbar:
+        stations = [sta for sta in grp if sta is not ap][:count]
+        pbar.set_description(f"AP {ap.host} x{len(stations)}")
+        postfix = {}
+        shown = {
+            sta.host: report_throughput(pbar, sta.host, postfix) for sta in stations
+        }
+        throughput = measure_clients(
+            ap,
+            stations,
+            "02:00",
+            duration,
+            data_folder,
+            channel=channel,
+            stream=stream,
+            assoc_timeout=assoc_timeout,
+            on_interval=lambda host, interval: shown[host](interval),
+        )
+        rows.append((ap.host, len(throughput), throughput))
+
+    click.echo(f"{'AP':<10} {'clients':>7} {'aggregate [Mbps]':>17}  per client [Mbps]")
+    for host, count, throughput in rows:
+        per_client = ", ".join(f"{k} {v * 1e-6:.1f}" for k, v in throughput.items())
+        aggregate = sum(throughput.values()) * 1e-6
+        click.echo(f"{host:<10} {count:>7} {aggregate:>17.1f}  {per_client}")
+    report_commands(trace)
 
 
 @cli.command(short_help="Select kernel")
 @click.option("--reboot", "-r", is_flag=True, help="Reboot nodes")
 @click.pass_context
 def select_kernel(ctx, reboot):
-    grp = get_all_nodes(ctx.obj["user"])
+    grp = get_all_nodes(ctx.obj["user"], timeout=ctx.obj["timeout"])
     possible_kernels = kernel.kernels(grp[0])
     print("Possible kernels")
     for ii, kern in enumerate(possible_kernels):
@@ -229,10 +954,125 @@ def select_kernel(ctx, reboot):
                 pass
 
 
+@cli.command(short_help="Run experiment for every installed kernel")
+@click.option(
+    "--kernel",
+    "-k",
+    "releases",
+    multiple=True,
+    help="Kernel release to measure, can be repeated (all installed if not given)",
+)
+@click.option("--duration", "-d", default=60, help="Iperf3 measurement duration")
+@click.option("--channel", "-c", default=6, help="Wifi channel to use")
+@click.option("--limit", "-l", help="Limit target hosts to comma separated list")
+@click.option(
+    "--parallel",
+    "-p",
+    is_flag=True,
+    help="Measure pairs without common nodes at the same time on separate channels",
+)
+@click.option(
+    "--ci-width",
+    type=float,
+    help="Stop once the confidence interval of the mean throughput is within "
+    "this relative width (--duration is then the maximum)",
+)
+@click.option(
+    "--min-duration", default=10, help="Minimum duration of adaptive measurements"
+)
+@click.option(
+    "--boot-cmd",
+    help="Local shell command booting the experiment OS after the reboot,"
+    " e.g. the bootos playbook",
+)
+@click.option(
+    "--boot-timeout", default=600, help="Maximum reboot time per kernel (in seconds)"
+)
+@click.pass_context
+def sweep(
+    ctx,
+    releases,
+    duration,
+    channel,
+    limit,
+    parallel,
+    ci_width,
+    min_duration,
+    boot_cmd,
+    boot_timeout,
+):
+    user = ctx.obj["user"]
+    if limit is not None:
+        limit = limit.split(",")
+    grp = get_all_nodes(user, limit, ctx.obj["timeout"])
+    if len(grp) < 2:
+        raise click.ClickException("At least two nodes are needed")
+    try:
+        installed = [k.release for k in kernel.common_kernels(grp)]
+    except ValueError as err:
+        raise click.ClickException(str(err)) from err
+    for release in releases:
+        if release not in installed:
+            raise click.BadParameter(f"{release} is not installed", param_hint="-k")
+    releases = list(releases) or installed
+    log.info(f"Sweeping kernels: {releases}")
+
+    executor = ThreadPoolExecutor(max_workers=len(grp))
+    try:
+        for release in releases:
+            hosts = [node.host for node in grp]
+            log.info(f"Switching {hosts} to {release}")
+            try:
+                list(executor.map(lambda node: kernel.switch(node, release), grp))
+            except ValueError as err:
+                raise click.ClickException(str(err)) from err
+            list(executor.map(kernel.reboot, grp))
+            down = list(executor.map(wait_down, hosts))
+            for host, is_down in zip(hosts, down):
+                if not is_down:
+                    log.warning(f"{host}: Did not go down for reboot")
+            if boot_cmd is not None:
+                try:
+                    subprocess.run(boot_cmd, shell=True, check=True)
+                except subprocess.CalledProcessError as err:
+                    raise click.ClickException(
+                        f"boot command failed with exit code {err.returncode}"
+                    ) from err
+            nodes = executor.map(
+                lambda host: wait_ready(host, release, user, boot_timeout), hosts
+            )
+            grp = []
+            for host, node in zip(hosts, nodes):
+                if node is None:
+                    log.error(f"{host}: Not up with {release} in {boot_timeout} s")
+                else:
+                    grp.append(node)
+            if len(grp) < 2:
+                raise click.ClickException(f"Not enough nodes up with {release}")
+
+            data_folder = (
+                BASE_PATH / "data" / f'{time.strftime("%Y-%m-%d-%H%M%S")}-{release}'
+            )
+            data_folder.mkdir(parents=True)
+            log.info(f"Storing measurements of {release} in {data_folder}")
+            progress = campaign(
+                grp,
+                data_folder,
+                duration=duration,
+                channel=channel,
+                parallel=parallel,
+                ci_width=ci_width,
+                min_duration=min_duration,
+            )
+            report(progress, duration=duration if ci_width is not None else None)
+    finally:
+        executor.shutdown()
+
+
 @cli.command(short_help="Node info")
 @click.pass_context
 def info(ctx):
-    grp = get_all_nodes(ctx.obj["user"])
+    grp = get_all_nodes(ctx.obj["user"], timeout=ctx.obj["timeout"])
 
     for node in grp:
         click.echo(click.style(node.host, fg="green", blink=True))
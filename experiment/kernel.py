@@ -1,4 +1,5 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from fabric import Connection
 
 Kernel = namedtuple("Kernel", "version release")
@@ -23,16 +24,55 @@ def kernels(ctx: Connection):
     return sorted(klist, key=version_key)
 
 
+def common_kernels(grp):
+    """Returns kernels installed on all nodes, checked concurrently
+
+    Args:
+        grp (list): nodes (Connection)
+
+    Raises:
+        ValueError: nodes have different kernel sets
+    """
+    with ThreadPoolExecutor(max_workers=max(len(grp), 1)) as executor:
+        klists = list(executor.map(kernels, grp))
+    for node, klist in zip(grp[1:], klists[1:]):
+        if set(klist) != set(klists[0]):
+            missing = set(klists[0]) ^ set(klist)
+            raise ValueError(
+                f"{node.host} and {grp[0].host} differ in kernels:"
+                f" {', '.join(sorted(k.release for k in missing))}"
+            )
+    return klists[0] if klists else []
+
+
 def switch(ctx: Connection, release: str):
     """Reboot node using kernel `release`
 
+    The symlinks are replaced by a single remote script, each of them
+    atomically (rename), keeping the previous ones as `.old`.
     """
-    result = ctx.run("ls /boot/vmlinuz*", hide=True)
-    if release not in result.stdout:
-        raise ValueError("Kernel {release} not found")
-    ctx.sudo("mv /vmlinuz /vmlinuz.old")
-    ctx.sudo("mv /initrd.img /initrd.img.old")
-    ctx.sudo(f"ln -fs boot/vmlinuz-{release} /vmlinuz")
-    ctx.sudo(f"ln -fs boot/initrd.img-{release} /initrd.img")
-
-    # ctx.sudo('reboot', hide=True)
+    script = " && ".join(
+        [
+            f"test -e /boot/vmlinuz-{release}",
+            f"test -e /boot/initrd.img-{release}",
+            "{ cp -Pf /vmlinuz /vmlinuz.old 2>/dev/null || true; }",
+            "{ cp -Pf /initrd.img /initrd.img.old 2>/dev/null || true; }",
+            f"ln -fs boot/vmlinuz-{release} /vmlinuz.new",
+            "mv -Tf /vmlinuz.new /vmlinuz",
+            f"ln -fs boot/initrd.img-{release} /initrd.img.new",
+            "mv -Tf /initrd.img.new /initrd.img",
+        ]
+    )
+    result = ctx.sudo(f'sh -c "{script}"', warn=True, hide=True)
+    if not result.ok:
+        raise ValueError(f"{ctx.host}: Could not switch to kernel {release}")
+
+
+def release(ctx: Connection):
+    """Returns release of the running kernel"""
+    return ctx.run("uname -r", hide=True).stdout.strip()
+
+
+def reboot(ctx: Connection):
+    """Reboots node without waiting for the connection to drop"""
+    ctx.sudo("sh -c 'sleep 1; reboot' > /dev/null 2>&1 &", warn=True, hide=True)
@@ -0,0 +1,132 @@
+import json
+import threading
+import yaml
+
+from pathlib import Path
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def result_complete(path: Path):
+    """Checks if iperf3 result file was completely written
+
+    Both a `--json` document and `--json-stream` lines are accepted, the
+    latter must end with the `end` event, or with the `stop` event of an
+    adaptive measurement that converged or ran for its maximum duration.
+
+    Args:
+        path (Path): result file
+    """
+    try:
+        text = path.read_text()
+    except FileNotFoundError:
+        return False
+    try:
+        result = json.loads(text)
+        return "end" in result and "error" not in result
+    except ValueError:
+        pass
+    lines = text.strip().splitlines()
+    if not lines:
+        return False
+    try:
+        event = json.loads(lines[-1])
+    except ValueError:
+        return False
+    if event.get("event") == "stop":
+        return event["data"]["reason"] in ("converged", "max_duration")
+    return event.get("event") == "end"
+
+
+class Manifest:
+    """Progress of a campaign, kept as `manifest.yaml` in its data folder.
+
+    Every ordered (AP, STA) pair is either pending, done or failed. A pair is
+    done only if its result file is complete, so measurements interrupted
+    while being written are measured again on resume.
+
+    Args:
+        folder (Path): data folder of the campaign
+        pairs (list): (AP, STA) host names of all pairs in the campaign
+    """
+
+    name = "manifest.yaml"
+
+    def __init__(self, folder: Path, pairs):
+        self.folder = folder
+        self.path = folder / self.name
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with self.path.open("r") as f:
+                self.pairs = yaml.safe_load(f)["pairs"]
+        else:
+            self.pairs = {}
+        for ap, sta in pairs:
+            self.pairs.setdefault(
+                self.key(ap, sta), {"ap": ap, "sta": sta, "status": PENDING}
+            )
+        for entry in self.pairs.values():
+            complete = result_complete(self.result_path(entry["ap"], entry["sta"]))
+            if entry["status"] == DONE and not complete:
+                entry["status"] = PENDING
+            elif complete:
+                entry["status"] = DONE
+        self.save()
+
+    @staticmethod
+    def key(ap, sta):
+        return f"{ap}-{sta}"
+
+    def result_path(self, ap, sta):
+        return self.folder / f"{self.key(ap, sta)}.json"
+
+    def pending(self, ap, sta):
+        """Checks if the pair still has to be measured"""
+        return self.pairs[self.key(ap, sta)]["status"] != DONE
+
+    def update(self, ap, sta, status=None, **info):
+        """Records outcome of a pair
+
+        Args:
+            ap (str): AP host name
+            sta (str): STA host name
+            status (str): new status, derived from the result file if None
+            info: additional values to store with the pair
+        """
+        if status is None:
+            status = DONE if result_complete(self.result_path(ap, sta)) else FAILED
+        with self._lock:
+            entry = self.pairs[self.key(ap, sta)]
+            entry.update(info)
+            entry["status"] = status
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            yaml.safe_dump({"pairs": self.pairs}, f, default_flow_style=False)
+        tmp.replace(self.path)
+
+    def summary(self):
+        """Returns number of pairs in each status"""
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        for entry in self.pairs.values():
+            counts[entry["status"]] += 1
+        return counts
+
+    def time_saved(self, duration):
+        """Returns measurement time (in seconds) saved by adaptive duration
+
+        Args:
+            duration (int): maximum measurement duration (in seconds)
+        """
+        return sum(
+            duration - e["seconds"] for e in self.pairs.values() if "seconds" in e
+        )
+
+    def mean_setup(self):
+        """Returns mean setup latency (in seconds) of measured pairs"""
+        setups = [e["setup"] for e in self.pairs.values() if "setup" in e]
+        return sum(setups) / len(setups) if setups else float("nan")
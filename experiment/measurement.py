@@ -1,5 +1,10 @@
+import json
+import math
+
 from fabric import Connection
 
+_json_stream = {}
+
 
 def iperf_server(cnx: Connection):
     """Starts iperf3 server in background.
@@ -11,6 +16,157 @@ def iperf_server(cnx: Connection):
     cnx.run("iperf3 --daemon --json --server")
 
 
+def iperf_servers(cnx: Connection, count: int, base_port: int = 5201):
+    """Starts `count` iperf3 servers in background, one per port.
+
+    An iperf3 server handles a single test at a time, so every concurrent
+    client needs its own port.
+
+    Args:
+        cnx (Connection): Fabric connection context
+        count (int): number of servers
+        base_port (int): port of the first server
+
+    Returns:
+        list of int: server ports
+    """
+    ports = list(range(base_port, base_port + count))
+    cnx.run("pkill iperf3", warn=True, hide=True)
+    cnx.run(
+        f"for port in {' '.join(map(str, ports))};"
+        f" do iperf3 --daemon --json --server --port $port || exit 1; done"
+    )
+    return ports
+
+
+def json_stream_supported(cnx: Connection):
+    """Checks (once per connection) if iperf3 supports `--json-stream`
+
+    Args:
+        cnx (Connection): Fabric connection context
+    """
+    if cnx not in _json_stream:
+        result = cnx.run("iperf3 --help", warn=True, hide=True)
+        _json_stream[cnx] = "--json-stream" in result.stdout + result.stderr
+    return _json_stream[cnx]
+
+
+def forget(cnx: Connection):
+    """Drops everything cached for the node, e.g. after it rebooted.
+
+    Args:
+        cnx (Connection): Fabric connection context
+    """
+    _json_stream.pop(cnx, None)
+
+
+class Convergence:
+    """Stopping rule for measurements of adaptive duration.
+
+    Collects per-interval throughput and decides to stop once the confidence
+    interval of the mean, relative to the mean, is at most `width` wide. The
+    measurement runs at least `min_duration` and at most `max_duration`
+    intervals.
+
+    Args:
+        min_duration (int): minimum number of intervals
+        max_duration (int): maximum number of intervals
+        width (float): target relative width of the confidence interval
+        z (float): quantile of the normal distribution, 1.96 for 95 %
+
+    Attributes:
+        reason (str): `converged` or `max_duration` once stopped, else None
+        count (int): number of collected intervals
+    """
+
+    CONVERGED = "converged"
+    MAX_DURATION = "max_duration"
+
+    def __init__(self, min_duration=10, max_duration=60, width=0.05, z=1.96):
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.width = width
+        self.z = z
+        self.reason = None
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, value):
+        """Adds one interval throughput (Welford's online variance)
+
+        Returns:
+            bool: True if the measurement should stop
+        """
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        if self.reason is not None:
+            return True
+        if self.count >= self.max_duration:
+            self.reason = self.MAX_DURATION
+        elif self.count >= self.min_duration and self.relative_width() <= self.width:
+            self.reason = self.CONVERGED
+        return self.reason is not None
+
+    def relative_width(self):
+        """Returns width of the confidence interval relative to the mean"""
+        if self.count < 2 or self._mean <= 0:
+            return math.inf
+        std = math.sqrt(self._m2 / (self.count - 1))
+        return 2 * self.z * std / math.sqrt(self.count) / self._mean
+
+
+class IntervalWriter:
+    """Output stream appending iperf3 `--json-stream` events to a file.
+
+    Every complete line is written and flushed as soon as it arrives, so an
+    interrupted measurement keeps all intervals received so far.
+
+    Args:
+        path (Path): local result file
+        title (str): test title, stored as the first event
+        on_interval (callable): called with the `sum` of every interval
+    """
+
+    def __init__(self, path, title=None, on_interval=None):
+        self.on_interval = on_interval
+        self._buffer = ""
+        self._file = path.open("w")
+        if title is not None:
+            self._file.write(json.dumps({"event": "title", "data": title}) + "\n")
+
+    def write(self, data):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            self._file.write(line + "\n")
+            self._file.flush()
+            if self.on_interval is None:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("event") == "interval":
+                self.on_interval(event["data"]["sum"])
+
+    def flush(self):
+        self._file.flush()
+
+    def event(self, name, data):
+        """Appends an event not produced by iperf3 (e.g. the stopping reason)"""
+        self._file.write(json.dumps({"event": name, "data": data}) + "\n")
+
+    def close(self):
+        if self._buffer.strip():
+            self._file.write(self._buffer + "\n")
+        self._file.close()
+
+
 def iperf_client(
     cnx: Connection,
     ip: str = "10.1.1.1",
@@ -18,15 +174,39 @@ def iperf_client(
     duration: int = 20,
     title: str = None,
     extra_args: str = "",
+    stream_to=None,
+    on_interval=None,
+    port: int = 5201,
+    start_at: float = None,
+    convergence: Convergence = None,
 ):
     """Starts iperf3 client
 
+    If `stream_to` is given, the result is written to this file. With an
+    iperf3 supporting `--json-stream` every interval is appended while the
+    test runs, otherwise the whole JSON document is written at the end.
+
+    With `start_at` the node itself sleeps until this (Unix) time before
+    starting iperf3, so clients on several nodes start in sync independently
+    of the SSH latency.
+
+    With `convergence` the test runs for its maximum duration, but is
+    interrupted as soon as the streamed throughput converged. The stopping
+    reason is appended to the result as a `stop` event. This requires
+    `--json-stream`, otherwise the test runs for `duration`.
+
     Args:
         cnx (Connection): Fabric connection context
         ip (str): Destination IP
         traffic (str): Traffic type (UDP or TCP)
         duration (int): Test duration (in seconds)
         extra_args (str): Additional iperf3 arguments
+        stream_to (Path): Local result file
+        on_interval (callable): called with the `sum` of every streamed
+            interval
+        port (int): Server port
+        start_at (float): Unix time to start the test at
+        convergence (Convergence): stopping rule of adaptive duration
     """
     cnx.run("pkill iperf3", warn=True, hide=True)
 
@@ -35,18 +215,114 @@ def iperf_client(
     else:
         conf = ""
     conf = conf + f' --title "{title}"' if title else conf
+    if port != 5201:
+        conf = f"-p {port} {conf}"
+    delay = ""
+    if start_at is not None:
+        delay = (
+            f"sleep $(awk -v t={start_at:.3f} -v n=$(date +%s.%N)"
+            f" 'BEGIN {{ print (t > n ? t - n : 0) }}'); "
+        )
+
+    if stream_to is not None and json_stream_supported(cnx):
+        if convergence is not None:
+            duration = convergence.max_duration
+            on_interval = converge(cnx, convergence, on_interval)
+        writer = IntervalWriter(stream_to, title=title, on_interval=on_interval)
+        try:
+            result = cnx.run(
+                (
+                    f"{delay}iperf3 --client {ip} -t {duration}"
+                    f" --json-stream --reverse"
+                    f" {conf} {extra_args}"
+                ),
+                hide="err",
+                warn=True,
+                out_stream=writer,
+            )
+            if convergence is not None:
+                if convergence.reason is None:
+                    # Ended early, e.g. the AP went away
+                    convergence.reason = "interrupted"
+                writer.event(
+                    "stop",
+                    {"reason": convergence.reason, "seconds": convergence.count},
+                )
+        finally:
+            writer.close()
+        return result
+
     result = cnx.run(
         (
-            f"iperf3 --client {ip} -t {duration}"
+            f"{delay}iperf3 --client {ip} -t {duration}"
             f" --json --reverse"
             f" {conf} {extra_args}"
         ),
         hide=True,
         warn=True,
     )
+    if stream_to is not None:
+        with stream_to.open("w") as f:
+            f.write(result.stdout)
     return result
 
 
+def converge(cnx: Connection, convergence: Convergence, on_interval=None):
+    """Returns interval callback interrupting iperf3 once `convergence` stops
+
+    Args:
+        cnx (Connection): Fabric connection context of the client
+        convergence (Convergence): stopping rule
+        on_interval (callable): called with every interval as well
+    """
+
+    def on_sample(interval):
+        if on_interval is not None:
+            on_interval(interval)
+        if convergence.reason is not None:
+            return
+        convergence.update(interval["bits_per_second"])
+        if convergence.reason == convergence.CONVERGED:
+            # SIGINT makes the client end the test and report to the server
+            cnx.run("pkill -INT -x iperf3", warn=True, hide=True)
+
+    return on_sample
+
+
+def result_throughput(path):
+    """Returns mean throughput (in bit/s) from the end of an iperf3 result
+
+    Both a `--json` document and `--json-stream` lines are accepted. The
+    received throughput is used for TCP, the only sum reported for UDP.
+
+    Args:
+        path (Path): local result file
+
+    Returns:
+        float: mean throughput, None if the result has none (e.g. it was
+        interrupted)
+    """
+    try:
+        text = path.read_text()
+    except FileNotFoundError:
+        return None
+    try:
+        end = json.loads(text).get("end", {})
+    except ValueError:
+        end = {}
+        for line in text.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("event") == "end":
+                end = event["data"]
+    for name in ("sum_received", "sum"):
+        if "bits_per_second" in end.get(name, {}):
+            return end[name]["bits_per_second"]
+    return None
+
+
 def iperf_kill(cnx: Connection):
     """Starts iperf3 server in background.
 
@@ -0,0 +1,56 @@
+from collections import namedtuple
+
+# Non-overlapping 2.4 GHz channels followed by 5 GHz channels without DFS
+CHANNELS = [1, 6, 11, 36, 40, 44, 48]
+
+Assignment = namedtuple("Assignment", "ap, sta, channel, ssid, subnet")
+
+
+def pairs(grp):
+    """Generator of all ordered (AP, STA) pairs in `select_one` order
+
+    Args:
+        grp (list): nodes taking part in the experiment
+    """
+    for i, ap in enumerate(grp):
+        for sta in grp[:i] + grp[i + 1 :]:
+            yield ap, sta
+
+
+def slots(pending, channels=CHANNELS, ssid="tkn_walker"):
+    """Groups ordered pairs into time slots of concurrent measurements.
+
+    Pairs within a slot share no node, and each of them gets its own
+    channel, SSID and subnet. Pairs are assigned greedily, so the order of
+    `pending` is kept as far as possible.
+
+    Args:
+        pending (list): (AP, STA) pairs to measure, e.g. from `pairs`
+        channels (list): channels that can be used at the same time
+        ssid (str): Network name prefix
+
+    Returns:
+        list of list of Assignment: measurements to run in each slot
+    """
+    pending = list(pending)
+    result = []
+    while pending:
+        busy = set()
+        slot = []
+        for ap, sta in pending:
+            if len(slot) == len(channels):
+                break
+            if ap in busy or sta in busy:
+                continue
+            busy.update((ap, sta))
+            idx = len(slot)
+            slot.append(
+                Assignment(
+                    ap, sta, channels[idx], f"{ssid}_{idx}", f"10.1.{idx + 1}"
+                )
+            )
+        pending = [
+            pair for pair in pending if pair not in [(a.ap, a.sta) for a in slot]
+        ]
+        result.append(slot)
+    return result
@@ -0,0 +1,72 @@
+import pyarrow as pa
+
+from pathlib import Path
+
+SCHEMA = pa.schema(
+    [
+        ("time", pa.float64()),
+        ("node", pa.dictionary(pa.int16(), pa.string())),
+        ("phy", pa.dictionary(pa.int16(), pa.string())),
+        ("bssid", pa.dictionary(pa.int32(), pa.string())),
+        ("freq", pa.int16()),
+        ("signal", pa.float32()),
+        ("ssid", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+
+
+class SurveyWriter:
+    """Appends scan records to an Arrow IPC stream file.
+
+    Every `write` adds one record batch and flushes it, so a survey
+    interrupted at any time keeps all batches written so far.
+
+    Args:
+        path (Path): output file (`.arrows`)
+    """
+
+    def __init__(self, path: Path):
+        self._sink = pa.OSFile(str(path), "wb")
+        self._writer = pa.ipc.new_stream(self._sink, SCHEMA)
+
+    def write(self, time, networks):
+        """Writes networks of one or more scans
+
+        Args:
+            time (list of float): Unix time of the scan of every network
+            networks (list of dict): networks from `wifi.scan_all`
+        """
+        if not networks:
+            return
+        columns = {
+            "time": time,
+            "node": [n["sta"] for n in networks],
+            "phy": [n.get("phy") for n in networks],
+            "bssid": [n["bssid"] for n in networks],
+            "freq": [n.get("freq") for n in networks],
+            "signal": [n.get("signal") for n in networks],
+            "ssid": [n.get("ssid") for n in networks],
+        }
+        self._writer.write_batch(pa.record_batch(columns, schema=SCHEMA))
+        self._sink.flush()
+
+    def close(self):
+        self._writer.close()
+        self._sink.close()
+
+
+def read(path: Path):
+    """Reads survey records, ignoring a batch truncated by an interruption
+
+    Returns:
+        pd.DataFrame: one row per network seen in a scan
+    """
+    batches = []
+    with pa.OSFile(str(path), "rb") as source:
+        reader = pa.ipc.open_stream(source)
+        while True:
+            try:
+                batches.append(reader.read_next_batch())
+            except (StopIteration, pa.ArrowInvalid, OSError):
+                break
+    return pa.Table.from_batches(batches, schema=SCHEMA).to_pandas()
@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+from fabric import Connection
+
+Span = namedtuple("Span", "host, command, phase, start, duration, thread")
+
+
+class Tracer:
+    """Records duration of remote commands, grouped by experiment phase.
+
+    The phase (e.g. setup, measure, teardown) is kept per thread, so
+    concurrent measurements can be traced independently.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+
+    @property
+    def current_phase(self):
+        return getattr(self._local, "phase", "setup")
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager setting phase of commands issued by this thread"""
+        previous = self.current_phase
+        self._local.phase = name
+        try:
+            yield
+        finally:
+            self._local.phase = previous
+
+    @contextmanager
+    def span(self, host, command):
+        """Context manager recording one remote command"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append(
+                Span(
+                    host,
+                    command,
+                    self.current_phase,
+                    start - self._t0,
+                    time.perf_counter() - start,
+                    threading.get_ident(),
+                )
+            )
+
+    def export_chrome(self, path):
+        """Writes spans as Chrome trace JSON (chrome://tracing, Perfetto)
+
+        Args:
+            path (Path): output file
+        """
+        hosts = {}
+        events = []
+        for span in self.spans:
+            if span.host not in hosts:
+                hosts[span.host] = len(hosts) + 1
+                events.append(
+                    {
+                        "name": "process_name",
+                        "ph": "M",
+                        "pid": hosts[span.host],
+                        "args": {"name": span.host},
+                    }
+                )
+            events.append(
+                {
+                    "name": span.command,
+                    "cat": span.phase,
+                    "ph": "X",
+                    "ts": span.start * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": hosts[span.host],
+                    "tid": span.thread,
+                }
+            )
+        with path.open("w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """Returns number of commands and their total duration per phase and
+        program, sorted by phase and descending duration
+
+        Returns:
+            list of tuple: (phase, program, count, total seconds)
+        """
+        totals = {}
+        for span in self.spans:
+            words = span.command.split()
+            if words and words[0] == "sudo" and len(words) > 1:
+                words = words[1:]
+            key = (span.phase, words[0] if words else "")
+            count, total = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, total + span.duration)
+        rows = [(phase, prog, *value) for (phase, prog), value in totals.items()]
+        return sorted(rows, key=lambda x: (x[0], -x[3]))
+
+    def table(self):
+        """Returns per-phase summary formatted as text table"""
+        lines = [f"{'phase':<10} {'command':<16} {'count':>6} {'total [s]':>10}"]
+        phases = {}
+        for phase, prog, count, total in self.summary():
+            lines.append(f"{phase:<10} {prog:<16} {count:>6} {total:>10.2f}")
+            phases[phase] = phases.get(phase, 0.0) + total
+        for phase, total in phases.items():
+            lines.append(f"{phase:<10} {'(all)':<16} {'':>6} {total:>10.2f}")
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+class TracedConnection(Connection):
+    """Fabric connection recording every `run`, `sudo` and `put` in `tracer`"""
+
+    def run(self, command, **kwargs):
+        with tracer.span(self.host, command):
+            return super().run(command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        with tracer.span(self.host, f"sudo {command}"):
+            return super().sudo(command, **kwargs)
+
+    def put(self, *args, **kwargs):
+        remote = kwargs.get("remote", args[1] if len(args) > 1 else "")
+        with tracer.span(self.host, f"put {remote}"):
+            return super().put(*args, **kwargs)
@@ -1,10 +1,9 @@
+import math
 import re
-import time
 
 from collections import namedtuple
 from fabric import Connection
 from hashlib import sha256
-from invoke.exceptions import UnexpectedExit
 from io import StringIO
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
@@ -13,9 +12,90 @@ from typing import Optional
 
 template_path = (Path(__file__).parent / "templates").resolve()
 jinja_env = Environment(loader=FileSystemLoader([template_path]))
+hostapd_tmpl = jinja_env.get_template("hostapd.conf.jn2")
+wpasup_tmpl = jinja_env.get_template("wpasup.conf.jn2")
 WiFiDev = namedtuple("WiFiDev", "phy, interface")
 
 
+class Topology:
+    """Wireless device topology of a single node.
+
+    Attributes:
+        links (dict): physical device name to its `/sys/class/ieee80211` entry
+            (contains the PCI bus of the device)
+        interfaces (dict): interface name to physical device name
+    """
+
+    def __init__(self, links, interfaces):
+        self.links = links
+        self.interfaces = interfaces
+
+
+_topology = {}
+
+
+def topology(cnx):
+    """Returns wireless device topology of the node.
+
+    The topology is discovered with a single remote call and cached per
+    connection. Functions in this module keep the cache up to date when they
+    add or delete interfaces; use `refresh` after changes done elsewhere.
+
+    Args:
+        cnx (Connection): fabric connection context
+
+    Returns:
+        Topology: cached topology of the node
+    """
+    topo = _topology.get(cnx)
+    if topo is not None:
+        return topo
+
+    result = cnx.run("ls -alh /sys/class/ieee80211/ && echo --- && iw dev", hide=True)
+    links_out, _, iw_out = result.stdout.partition("---")
+    links = {}
+    for line in links_out.splitlines():
+        line = line.strip()
+        if line.startswith("l"):
+            links[line.split("/")[-1]] = line
+    interfaces = {}
+    phy = None
+    for line in iw_out.splitlines():
+        line = line.strip()
+        if line.startswith("phy#"):
+            phy = "phy" + line[4:]
+        elif line.startswith("Interface"):
+            interfaces[line.split(" ")[-1]] = phy
+
+    topo = Topology(links, interfaces)
+    _topology[cnx] = topo
+    return topo
+
+
+def refresh(cnx):
+    """Drops cached topology and discovers it again.
+
+    Args:
+        cnx (Connection): fabric connection context
+
+    Returns:
+        Topology: current topology of the node
+    """
+    _topology.pop(cnx, None)
+    return topology(cnx)
+
+
+def forget(cnx):
+    """Drops everything cached for the node, e.g. after it rebooted.
+
+    Args:
+        cnx (Connection): fabric connection context
+    """
+    _topology.pop(cnx, None)
+    for key in [key for key in _uploaded if key[0] == cnx]:
+        del _uploaded[key]
+
+
 def phy_resolve(cnx, phy=None):
     """Resolves physical device name.
 
@@ -27,20 +107,13 @@ def phy_resolve(cnx, phy=None):
         phy (str): Physical device. If not None it will force create new
             interface on this device.
     """
-    result = cnx.run("ls -alh /sys/class/ieee80211/", hide=True)
-    phy_all = []
-    for line in result.stdout.splitlines():
-        if (phy is None) and line.startswith("l"):
-            phy_dev = line.strip().split("/")[-1]
-            phy_all.append(phy_dev)
-        elif phy in line:
-            phy_dev = line.strip().split("/")[-1]
+    links = topology(cnx).links
+    if phy is None:
+        return list(links)
+    for phy_dev, line in links.items():
+        if phy in line:
             return phy_dev
-    else:
-        if phy is None:
-            phy_all
-        else:
-            raise AttributeError("Could not find device")
+    raise AttributeError("Could not find device")
 
 
 def ifaces(cnx):
@@ -52,14 +125,8 @@ def ifaces(cnx):
     Returns:
         Generator of WiFiDev: information about all devices
     """
-    for line in cnx.run("iw dev", hide=True).stdout.splitlines():
-        line = line.strip()
-        if line.startswith("Interface"):
-            iface = line.split(" ")[-1]
-            result = cnx.run(f"iw dev {iface} info", hide=True)
-            match = re.search(r"wiphy (\d+)", result.stdout)
-            phy = "phy" + match.group(1)
-            yield WiFiDev(phy, iface)
+    for iface, phy in list(topology(cnx).interfaces.items()):
+        yield WiFiDev(phy, iface)
 
 
 def phy_check(cnx, phy=None, interface=None, suffix="_w"):
@@ -89,21 +156,58 @@ def phy_check(cnx, phy=None, interface=None, suffix="_w"):
         # Clean interfaces
         phy_clean(cnx, phy)
         cnx.sudo(f"iw {phy} interface add {interface} type managed")
+        topology(cnx).interfaces[interface] = phy
         return WiFiDev(phy, interface)
 
     if interface is None:
         raise AttributeError("Either phy or interface must be set")
-    try:
-        result = cnx.run(f"iw dev {interface} info", hide=True)
-        match = re.search(r"wiphy (?P<dev>\d+)", result.stdout)
-        phy = "phy" + match.group(1)
-        # cnx.sudo(f'iw {interface} del')
-    except UnexpectedExit as e:
-        if e.result.exited == 237:
-            raise AttributeError(f"No such interface ({interface})") from e
-        else:
-            raise
-    return WiFiDev(phy, interface)
+    interfaces = topology(cnx).interfaces
+    if interface not in interfaces:
+        interfaces = refresh(cnx).interfaces
+    if interface not in interfaces:
+        raise AttributeError(f"No such interface ({interface})")
+    return WiFiDev(interfaces[interface], interface)
+
+
+def remote_wait(cnx, condition, timeout=10, interval=0.05):
+    """Blocks on the node until shell `condition` succeeds.
+
+    The condition is polled by a loop running on the node itself, so waiting
+    costs a single round trip and returns within `interval` of the change.
+
+    Args:
+        cnx (Connection): fabric connection context
+        condition (str): shell command, must not contain single quotes
+        timeout (float): maximum waiting time (in seconds)
+        interval (float): polling interval on the node (in seconds)
+
+    Returns:
+        bool: False if `timeout` expired
+    """
+    # Deadline in elapsed time (ms), checking the condition takes time as well
+    now = "$(( $(date +%s%N) / 1000000 ))"
+    script = (
+        f"end=$(( {now} + {math.ceil(timeout * 1000)} ));"
+        f" while true; do {condition} && exit 0;"
+        f" [ {now} -lt $end ] || exit 1; sleep {interval}; done"
+    )
+    return cnx.sudo(f"sh -c '{script}'", warn=True, hide=True).ok
+
+
+def stop_daemons(cnx, phy="", timeout=5):
+    """Stops hostapd and wpa_supplicant of `phy` and waits until they exit.
+
+    Args:
+        cnx (Connection): fabric connection context
+        phy (str): Physical device name, all devices if empty
+        timeout (float): maximum waiting time (in seconds)
+    """
+    # Brackets keep the pattern from matching the command line of this shell
+    pattern = f"[h]ostapd.*{phy}|[w]pa_supplicant.*{phy}"
+    if not cnx.sudo(f'pkill -f "{pattern}"', warn=True, hide=True).ok:
+        return
+    if not remote_wait(cnx, f'! pgrep -f "{pattern}" > /dev/null', timeout):
+        raise EnvironmentError(f"{cnx.host}: hostapd/wpa_supplicant did not exit")
 
 
 def phy_clean(cnx, phy=None):
@@ -119,12 +223,12 @@ def phy_clean(cnx, phy=None):
     else:
         phy = phy_resolve(cnx, phy)
 
-    cnx.sudo(f"pkill -f hostapd.*{phy}", warn=True)
-    cnx.sudo(f"pkill -f wpa_supplicant.*{phy}", warn=True)
+    stop_daemons(cnx, phy)
 
     for dev in ifaces(cnx):
         if not phy or (phy == dev.phy):
             cnx.sudo(f"iw {dev.interface} del")
+            topology(cnx).interfaces.pop(dev.interface, None)
 
 
 def info(cnx):
@@ -138,13 +242,16 @@ def info(cnx):
     cnx.run('lspci -nnk | grep "Wireless" -A2')
 
 
-def generate_ip(cnx):
+def generate_ip(cnx, subnet="10.1.1"):
     """Generates persistent IP address for node
 
+    Args:
+        cnx (Connection): fabric connection context
+        subnet (str): first three octets of the address
     """
     hashval = sha256(cnx.host.encode("utf-8")).hexdigest()
     ip_hash = int(hashval, 16) % 2 ** 8
-    ip = f"10.1.1.{ip_hash}"
+    ip = f"{subnet}.{ip_hash}"
     return ip
 
 
@@ -167,6 +274,36 @@ def reload(cnx):
         cnx.sudo("rmmod -f {}".format(mod), warn=True)
     for mod in custom_modules:
         cnx.sudo("modprobe {}".format(mod))
+    refresh(cnx)
+
+
+_uploaded = {}
+
+
+def upload(cnx: Connection, content: str, remote: str):
+    """Uploads `content` to `remote` file, unless the node already has it.
+
+    The hash of every uploaded file is recorded per connection. Unless the
+    content changed since the last upload, `sha256sum` on the node decides
+    (in one call) if the SFTP transfer can be skipped.
+
+    Args:
+        cnx (Connection): fabric connection context
+        content (str): file content
+        remote (str): remote path, relative to the home directory
+
+    Returns:
+        bool: True if the file was transferred
+    """
+    digest = sha256(content.encode("utf-8")).hexdigest()
+    if _uploaded.get((cnx, remote), digest) == digest:
+        result = cnx.run(f"sha256sum {remote}", warn=True, hide=True)
+        if result.ok and result.stdout.split(" ")[0] == digest:
+            _uploaded[(cnx, remote)] = digest
+            return False
+    cnx.put(StringIO(content), remote)
+    _uploaded[(cnx, remote)] = digest
+    return True
 
 
 def create_ap(
@@ -196,24 +333,19 @@ def create_ap(
     """
     phy, interface = phy_check(cnx, phy, interface, "_ap")
 
-    old_wpa = cnx.sudo(f"pkill -f wpa_supplicant.*{phy}", warn=True)
-    old_hostapd = cnx.sudo(f"pkill -f hostapd.*{phy}", warn=True)
-    if old_wpa or old_hostapd:
-        time.sleep(2)
-
-    tmpl = jinja_env.get_template("hostapd.conf.jn2")
-    cnx.put(
-        StringIO(
-            tmpl.render(
-                {
-                    "channel": channel,
-                    "hw_mode": "g" if channel < 15 else "a",
-                    "interface": interface,
-                    "ssid": ssid,
-                    "bssid": bssid,
-                    "psk": psk,
-                }
-            )
+    stop_daemons(cnx, phy)
+
+    upload(
+        cnx,
+        hostapd_tmpl.render(
+            {
+                "channel": channel,
+                "hw_mode": "g" if channel < 15 else "a",
+                "interface": interface,
+                "ssid": ssid,
+                "bssid": bssid,
+                "psk": psk,
+            }
         ),
         f"hostapd-{interface}.conf",
     )
@@ -243,6 +375,7 @@ def connect(
     ssid="tkn_walker",
     psk=None,
     ip=None,
+    timeout=10,
 ):
     """Task to connect a node to an AP.
 
@@ -253,7 +386,8 @@ def connect(
         interface (str): Wi-Fi interface
         ssid (str): Network name
         psk (str): Password
-        ip (str): IP address of the AP
+        ip (str): IP address of the station
+        timeout (float): maximum association time (in seconds)
 
     Returns:
         WiFiDev: information about used device
@@ -263,10 +397,7 @@ def connect(
     if ip is None:
         ip = generate_ip(cnx)
 
-    old_wpa = cnx.sudo(f"pkill -f wpa_supplicant.*{phy}", warn=True)
-    old_hostapd = cnx.sudo(f"pkill -f hostapd.*{phy}", warn=True)
-    if old_wpa or old_hostapd:
-        time.sleep(2)
+    stop_daemons(cnx, phy)
 
     # Clean up interface
     cnx.sudo("rfkill unblock wifi", warn=True, hide=True)
@@ -274,9 +405,9 @@ def connect(
     cnx.sudo(f"ip addr flush dev {interface}")
     cnx.sudo(f"iw dev {interface} set type managed")
 
-    tmpl = jinja_env.get_template("wpasup.conf.jn2")
-    cnx.put(
-        StringIO(tmpl.render({"interface": interface, "ssid": ssid, "psk": psk})),
+    upload(
+        cnx,
+        wpasup_tmpl.render({"interface": interface, "ssid": ssid, "psk": psk}),
         f"wpasup-{interface}.conf",
     )
 
@@ -292,18 +423,98 @@ def connect(
         )
     )
     cnx.sudo(f"ip addr add {ip}/24 dev {interface}")
-    for _ in range(10):
-        time.sleep(1)
-        result = cnx.sudo(
-            f"wpa_cli -p /run/wpasup-{interface} status", warn=True, hide=True
-        )
-        if "wpa_state=COMPLETED" in result.stdout:
-            break
-    else:
-        raise EnvironmentError(f"Could not connect to {ssid}")
+    wait_associated(cnx, interface, ssid, timeout)
     return WiFiDev(phy, interface)
 
 
+def wait_associated(cnx, interface, ssid="tkn_walker", timeout=10):
+    """Waits until wpa_supplicant on `interface` completed the association.
+
+    Args:
+        cnx (Connection): fabric connection context
+        interface (str): Wi-Fi interface
+        ssid (str): Network name (for the error message)
+        timeout (float): maximum waiting time (in seconds)
+    """
+    completed = remote_wait(
+        cnx,
+        f"wpa_cli -p /run/wpasup-{interface} status | grep -q wpa_state=COMPLETED",
+        timeout,
+    )
+    if not completed:
+        raise EnvironmentError(f"Could not connect to {ssid}")
+
+
+def reassociate(cnx: Connection, interface: str, ssid="tkn_walker", timeout=10):
+    """Re-associates a station set up with `connect`, e.g. to a new AP.
+
+    The interface and wpa_supplicant are kept, so only the association
+    itself is repeated.
+
+    Args:
+        cnx (Connection): fabric connection context
+        interface (str): Wi-Fi interface
+        ssid (str): Network name
+        timeout (float): maximum association time (in seconds)
+    """
+    cnx.sudo(f"wpa_cli -p /run/wpasup-{interface} reassociate", hide=True)
+    wait_associated(cnx, interface, ssid, timeout)
+
+
+def disconnect(cnx: Connection, interface: str):
+    """Disconnects a station set up with `connect`, keeping wpa_supplicant.
+
+    Args:
+        cnx (Connection): fabric connection context
+        interface (str): Wi-Fi interface
+    """
+    cnx.sudo(f"wpa_cli -p /run/wpasup-{interface} disconnect", hide=True)
+
+
+# Lines of `iw scan` output used by `parse_scan`, matched in a single pass
+SCAN_LINE = re.compile(
+    r"^BSS (?P<bssid>(?:[0-9a-f]{2}:){5}[0-9a-f]{2})\(on (?P<dev>\w+)\)"
+    r"|^\s+freq: (?P<freq>\d+)"
+    r"|^\s+signal: (?P<signal>-?[\d.]+) dBm"
+    r"|^\s+SSID: (?P<ssid>.*)$",
+    re.MULTILINE,
+)
+
+
+def parse_scan(output: str, host: str):
+    """Parses `iw scan` output (of one or more interfaces)
+
+    Args:
+        output (str): scan output
+        host (str): scanning node
+
+    Returns:
+        list of dict: networks with bssid, sta_dev, sta, freq (MHz), signal
+        (dBm) and ssid
+    """
+    networks = []
+    curr = None
+    for match in SCAN_LINE.finditer(output):
+        kind = match.lastgroup
+        if kind == "dev":
+            if curr is not None and "ssid" in curr:
+                networks.append(curr)
+            curr = dict(
+                bssid=match.group("bssid"), sta_dev=match.group("dev"), sta=host
+            )
+        elif curr is None:
+            continue
+        elif kind == "freq":
+            curr["freq"] = int(match.group("freq"))
+        elif kind == "signal":
+            curr["signal"] = float(match.group("signal"))
+        elif kind == "ssid" and "ssid" not in curr:
+            curr["ssid"] = match.group("ssid")
+    if curr is not None and "ssid" in curr:
+        networks.append(curr)
+    return networks
+
+
 def scan(cnx: Connection, phy: Optional[str] = None, interface: Optional[str] = None):
     """Returns wireless scan of networks from given interface
 
@@ -322,29 +533,47 @@ def scan(cnx: Connection, phy: Optional[str] = None, interface: Optional[str] =
         cnx.sudo(f"ip link set {interface} up", hide=True)
 
     scan_result = cnx.sudo(f"iw dev {interface} scan", hide=True)
-
-    networks = []
-    curr = None
-    for line in scan_result.stdout.splitlines():
-        line = line.strip()
-        match = re.search(r"BSS (?P<bssid>([0-9a-f]{2}:?){6})\(on (?P<dev>\w*)\)", line)
-        if match:
-            if (curr is not None) and ("ssid" in curr):
-                networks.append(curr)
-            curr = dict(
-                bssid=match.group("bssid"), sta_dev=match.group("dev"), sta=cnx.host
-            )
-        sgr = [
-            ("freq", r"freq: (\d*)"),
-            ("signal", r"signal: (.*)"),
-            ("ssid", r"SSID: (.*)"),
-        ]
-        for name, pattern in sgr:
-            match = re.search(pattern, line)
-            if match:
-                curr[name] = match.group(1)
+    networks = parse_scan(scan_result.stdout, cnx.host)
 
     if not if_up_check:
         cnx.sudo(f"ip link set {interface} down", hide=True)
 
     return networks
+
+
+def scan_setup(cnx: Connection):
+    """Creates a scanning interface on every physical device of the node
+
+    Args:
+        cnx (Connection): fabric connection context
+
+    Returns:
+        list of WiFiDev: scanning interfaces
+    """
+    devices = [phy_check(cnx, phy, suffix="_scan") for phy in phy_resolve(cnx)]
+    links = " && ".join(f"ip link set {dev.interface} up" for dev in devices)
+    cnx.sudo(f"sh -c '{links}'", hide=True)
+    return devices
+
+
+def scan_all(cnx: Connection, devices):
+    """Scans on all `devices` at the same time, in a single remote call
+
+    Args:
+        cnx (Connection): fabric connection context
+        devices (list of WiFiDev): interfaces from `scan_setup`
+
+    Returns:
+        list of networks (see `parse_scan`), with the physical device added
+    """
+    names = " ".join(dev.interface for dev in devices)
+    script = (
+        f"for i in {names}; do iw dev $i scan > /tmp/scan-$i 2>&1 & done; wait;"
+        f" for i in {names}; do cat /tmp/scan-$i; done"
+    )
+    result = cnx.sudo(f"sh -c '{script}'", hide=True, warn=True)
+    phys = {dev.interface: dev.phy for dev in devices}
+    networks = parse_scan(result.stdout, cnx.host)
+    for network in networks:
+        network["phy"] = phys.get(network["sta_dev"])
+    return networks
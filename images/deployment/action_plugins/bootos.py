@@ -1,25 +1,168 @@
+import errno
 import logging
-import multiprocessing
+import random
+import selectors
 import socket
+import threading
 import time
 
 from ansible.plugins.action import ActionBase
-from contextlib import closing
 from fabric import Connection
+from invoke.exceptions import CommandTimedOut
+from paramiko.ssh_exception import SSHException
 
 
 logger = logging.getLogger("bootos")
 logger.setLevel(logging.DEBUG)
 
 
-def check_port(host, port):
-    logger.debug("checking ssh port for {}:{}".format(host, port))
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        if sock.connect_ex((host, int(port))) == 0:
+class ReadinessPoller(object):
+    """Watches TCP ports of many hosts from a single thread.
+
+    Every watched port is probed with a non-blocking connect, all pending
+    connects are multiplexed with epoll (`selectors`). Failed probes are
+    repeated with exponential backoff and jitter, capped at `max_delay`, so
+    a host is signalled at most `max_delay` after its port opens.
+
+    Args:
+        initial_delay (float): delay after the first failed probe (in seconds)
+        max_delay (float): maximum delay between probes (in seconds)
+        connect_timeout (float): maximum duration of a single probe
+    """
+
+    def __init__(self, initial_delay=0.05, max_delay=0.5, connect_timeout=1.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self._selector = selectors.DefaultSelector()
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = None
+
+    def watch(self, host, port=22):
+        """Starts watching `host`, returns event set once the port is open"""
+        key = (host, int(port))
+        with self._lock:
+            target = self._targets.get(key)
+            if target is None:
+                target = {
+                    "event": threading.Event(),
+                    "delay": self.initial_delay,
+                    "due": time.monotonic(),
+                    "sock": None,
+                }
+                self._targets[key] = target
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup_w.send(b"\0")
+        return target["event"]
+
+    def forget(self, host, port=22):
+        """Stops watching `host`"""
+        with self._lock:
+            target = self._targets.pop((host, int(port)), None)
+        if target is not None and target["sock"] is not None:
+            self._close(target)
+
+    def wait(self, host, port=22, timeout=None):
+        """Blocks until the port of `host` is open
+
+        Returns:
+            bool: False if `timeout` expired
+        """
+        if self.watch(host, port).wait(timeout):
+            self.forget(host, port)
             return True
+        return False
+
+    def _close(self, target):
+        try:
+            self._selector.unregister(target["sock"])
+        except (KeyError, ValueError):
+            pass
+        target["sock"].close()
+        target["sock"] = None
+
+    def _probe(self, key, target, now):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex(key)
+        except socket.gaierror:
+            sock.close()
+            self._retry(target, now)
+            return
+        if err == 0:
+            sock.close()
+            target["event"].set()
+        elif err in (errno.EINPROGRESS, errno.EAGAIN):
+            target["sock"] = sock
+            target["due"] = now + self.connect_timeout
+            self._selector.register(sock, selectors.EVENT_WRITE, key)
         else:
-            logger.debug("ssh port not open: {}@{}".format(host, port))
-            return False
+            sock.close()
+            self._retry(target, now)
+
+    def _retry(self, target, now):
+        target["due"] = now + target["delay"] * random.uniform(0.5, 1.0)
+        target["delay"] = min(target["delay"] * 2, self.max_delay)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                targets = [
+                    (key, target)
+                    for key, target in self._targets.items()
+                    if not target["event"].is_set()
+                ]
+                if not targets:
+                    self._thread = None
+                    return
+                for key, target in targets:
+                    if target["due"] > now:
+                        continue
+                    if target["sock"] is not None:
+                        # Probe timed out, e.g. the host is still down
+                        self._close(target)
+                        self._retry(target, now)
+                    else:
+                        self._probe(key, target, now)
+                due = min(target["due"] for _, target in targets)
+
+            for selector_key, _ in self._selector.select(max(due - now, 0)):
+                if selector_key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(4096)
+                    continue
+                with self._lock:
+                    target = self._targets.get(selector_key.data)
+                    if target is None or target["sock"] is not selector_key.fileobj:
+                        continue
+                    err = target["sock"].getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR
+                    )
+                    self._close(target)
+                    if err == 0:
+                        logger.debug("port open: {}:{}".format(*selector_key.data))
+                        target["event"].set()
+                    else:
+                        self._retry(target, time.monotonic())
+
+
+poller = ReadinessPoller()
+
+
+def check_port(host, port, timeout=1.0):
+    logger.debug("checking ssh port for {}:{}".format(host, port))
+    if poller.wait(host, port, timeout):
+        return True
+    poller.forget(host, port)
+    logger.debug("ssh port not open: {}@{}".format(host, port))
+    return False
 
 
 def get_status(host, user):
@@ -31,12 +174,15 @@ def get_status(host, user):
         return "experiment"
 
 
-def wait_for_host(host, user, timeout, delay=0):
+def wait_for_host(host, user, timeout):
     host_string = "{:s}@{:s}".format(user, host)
     logger.debug("wait for host {}".format(host_string))
-    time.sleep(delay)
-    t_start = time.time()
-    while time.time() < (t_start + timeout):
+    t_end = time.monotonic() + timeout
+    login_delay = poller.initial_delay
+    while time.monotonic() < t_end:
+        # Returns as soon as the poller sees the ssh port open
+        if not poller.wait(host, 22, t_end - time.monotonic()):
+            break
         try:
             res = run_cmd(host, user, "/bin/true")
             if res == 0:
@@ -46,62 +192,113 @@ def wait_for_host(host, user, timeout, delay=0):
             logger.debug("failed login to {}".format(host_string))
 
         logger.debug(
-            "waiting {:.2f}s for {}".format(
-                t_start + timeout - time.time(), host_string
-            )
+            "waiting {:.2f}s for {}".format(t_end - time.monotonic(), host_string)
         )
-        time.sleep(5)
-    raise Exception
+        # Port is open but login failed (e.g. sshd still starting)
+        time.sleep(login_delay * random.uniform(0.5, 1.0))
+        login_delay = min(login_delay * 2, poller.max_delay)
+    poller.forget(host, 22)
+    raise TimeoutError("{} not ready in {}s".format(host_string, timeout))
+
+
+def wait_for_status(host, user, status, timeout):
+    """Waits until `host` is up with the `status` image ("base" or "experiment")
+
+    Right after the reboot command the old system may still accept logins,
+    so the status is checked until it changed instead of sleeping first.
+    """
+    t_end = time.monotonic() + timeout
+    while True:
+        wait_for_host(host, user, t_end - time.monotonic())
+        try:
+            if get_status(host, user) == status:
+                return
+        except Exception:
+            logger.debug("failed status check of {}@{}".format(user, host))
+        pool.discard(host, user)
+        if time.monotonic() >= t_end:
+            raise TimeoutError(
+                "{}@{} not up with {} in {}s".format(user, host, status, timeout)
+            )
+        time.sleep(poller.max_delay)
+
+
+class ConnectionPool(object):
+    """Reusable SSH connections, one per (host, user).
+
+    A connection is opened on first use and kept for following commands.
+    Broken connections (e.g. after a reboot) are dropped and opened again on
+    next use.
+    """
+
+    def __init__(self, connect_timeout=10):
+        self.connect_timeout = connect_timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, user):
+        with self._lock:
+            ctx = self._connections.get((host, user))
+            if ctx is not None and ctx.is_connected:
+                return ctx
+            if ctx is not None:
+                ctx.close()
+            ctx = Connection(
+                host,
+                user=user,
+                connect_timeout=self.connect_timeout,
+                connect_kwargs={
+                    "banner_timeout": self.connect_timeout,
+                    "auth_timeout": self.connect_timeout,
+                },
+            )
+            self._connections[(host, user)] = ctx
+        ctx.open()
+        return ctx
 
+    def discard(self, host, user):
+        with self._lock:
+            ctx = self._connections.pop((host, user), None)
+        if ctx is not None:
+            ctx.close()
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for ctx in connections:
+            ctx.close()
 
-class FabricProcess(multiprocessing.Process):
-    def __init__(self, user, host, cmd, privileged):
-        super(FabricProcess, self).__init__()
-        self.ctx = Connection(host, user=user)
-        self.operation = (
-            self.ctx.sudo if (user != "root" and privileged) else self.ctx.run
-        )
-        self.cmd = cmd
-        self.return_code = multiprocessing.Value("i", -1)
 
-    def run(self):
-        res = self.operation(self.cmd, shell=False, hide=True, warn=True)
-        self.ctx.close()
-        self.return_code.value = res.return_code
+pool = ConnectionPool()
 
 
-def run_cmd(host, user, cmd, privileged=False):
+def run_cmd(host, user, cmd, privileged=False, timeout=10):
     logger.debug('run cmd "{}" on {}@{}'.format(cmd, user, host))
 
     port = 22
-    command_timeout = 10
 
     if not check_port(host, port):
-        raise Exception
-
-    logger.debug("ssh port open on {}@{}".format(user, host))
-    logger.debug("spawning fabric process..")
-
-    fp = FabricProcess(user, host, cmd, privileged)
-    fp.start()
-
-    t_start = time.time()
-    while time.time() < (t_start + command_timeout):
-        if fp.exitcode is not None:
-            break
-        time.sleep(1)
-
-    if fp.exitcode is None:
-        fp.terminate()
+        raise ConnectionError("ssh port not open: {}@{}".format(host, port))
+
+    try:
+        ctx = pool.get(host, user)
+        operation = ctx.sudo if (user != "root" and privileged) else ctx.run
+        res = operation(cmd, hide=True, warn=True, timeout=timeout)
+    except CommandTimedOut:
+        pool.discard(host, user)
         logger.debug('timeout run cmd "{}" on {}@{}'.format(cmd, user, host))
         raise TimeoutError()
+    except (SSHException, EOFError, OSError):
+        pool.discard(host, user)
+        raise
 
     logger.debug(
         'passed run cmd "{}" on {}@{}. Exit code: {}'.format(
-            cmd, user, host, fp.return_code.value
+            cmd, user, host, res.return_code
         )
     )
-    return fp.return_code.value
+    return res.return_code
 
 
 class ActionModule(ActionBase):
@@ -109,6 +306,12 @@ class ActionModule(ActionBase):
         if task_vars is None:
             task_vars = dict()
 
+        try:
+            return self._run(tmp, task_vars)
+        finally:
+            pool.close()
+
+    def _run(self, tmp, task_vars):
         result = super(ActionModule, self).run(tmp, task_vars)
         args = self._task.args.copy()
 
@@ -150,24 +353,18 @@ class ActionModule(ActionBase):
 
         logger.debug("run kexec on {}".format(host))
         res = self._execute_module(module_args=args, task_vars=task_vars)
+        pool.discard(host, user)
 
-        wait_for_host(host, experimentuser, 240, delay=10)
-        status = get_status(host, experimentuser)
-        if status == "experiment":
-            return res
-        else:
-            raise Exception
+        wait_for_status(host, experimentuser, "experiment", 240)
+        return res
 
     def boot_base(self, host, user):
         logger.debug("boot {} to base".format(host))
         status = get_status(host, user)
         if status != "base":
             ret = run_cmd(host, user, "reboot", True)
+            pool.discard(host, user)
             if ret != 0:
                 raise Exception
 
-        wait_for_host(host, user, 240, delay=10)
-        if get_status(host, user) == "base":
-            return
-        else:
-            raise Exception
+        wait_for_status(host, user, "base", 240)
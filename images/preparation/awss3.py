@@ -1,30 +1,85 @@
 import boto3
+import hashlib
 import threading
+import time
 import os
 import sys
 
-s3 = boto3.client("s3")
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
 bucket = "twistimages"
+MB = 1024 * 1024
+
+_s3 = None
+
+
+def client():
+    """Returns S3 client, created on first use
+
+    Set `S3_ENDPOINT_URL` to use another S3 implementation, e.g. a local
+    MinIO server or moto.
+    """
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL"))
+    return _s3
 
 
 class AWSProgressPercentage(object):
-    def __init__(self, filesize):
+    def __init__(self, filesize, interval=0.5):
         self._size = filesize
         self._seen_so_far = 0
+        self._interval = interval
+        self._last_write = 0.0
         self._lock = threading.Lock()
 
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                "\r %s / %s  (%.2f%%)" % (self._seen_so_far, self._size, percentage)
-            )
-            sys.stdout.flush()
+            now = time.monotonic()
+            if now - self._last_write < self._interval and (
+                self._seen_so_far < self._size
+            ):
+                return
+            self._last_write = now
+            seen_so_far = self._seen_so_far
+        percentage = (seen_so_far / self._size) * 100
+        sys.stdout.write("\r %s / %s  (%.2f%%)" % (seen_so_far, self._size, percentage))
+        sys.stdout.flush()
+
 
+def file_digest(filepath, chunk_size=8 * MB):
+    """Returns SHA-256 hex digest of the file"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def upload(filepath, url_type="generated"):
 
+def stored_digest(s3, key):
+    """Returns SHA-256 digest stored with the object, None if there is none"""
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return head.get("Metadata", {}).get("sha256")
+
+
+def upload(filepath, url_type="generated", part_size=64, concurrency=8):
+    """Uploads file to the bucket, unless the same content is already there.
+
+    The SHA-256 digest of the file is stored in the object metadata and
+    compared before uploading. Large files are uploaded in parts of
+    `part_size` MB, `concurrency` of them at a time.
+
+    Returns:
+        str: URL of the object
+    """
+    s3 = client()
     filesize = float(os.path.getsize(filepath))
     key = os.path.basename(filepath)
 
@@ -42,12 +97,23 @@ def upload(filepath, url_type="generated"):
     else:
         raise NotImplementedError()
 
+    digest = file_digest(filepath)
+    if stored_digest(s3, key) == digest:
+        print(f"{key} is already uploaded")
+        s3.put_object_acl(Bucket=bucket, Key=key, ACL=acl)
+        return url
+
     s3.upload_file(
         filepath,
         bucket,
         key,
-        ExtraArgs={"ACL": acl},
+        ExtraArgs={"ACL": acl, "Metadata": {"sha256": digest}},
         Callback=AWSProgressPercentage(filesize),
+        Config=TransferConfig(
+            multipart_threshold=part_size * MB,
+            multipart_chunksize=part_size * MB,
+            max_concurrency=concurrency,
+        ),
     )
 
     sys.stdout.write("\n")
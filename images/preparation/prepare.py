@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import pathlib
 import jinja2
@@ -6,14 +7,77 @@ import yaml
 import tempfile
 import invoke
 import click
+import time
 import awss3 as cloudstorage
 
 BASE_PATH = pathlib.Path(__file__).absolute().parents[2]
+ELEMENTS_PATH = pathlib.Path(__file__).absolute().parents[0] / "add_elements"
+# diskimage-builder keeps base images, apt archives and (with the
+# mainline-kernel element) kernel packages here between builds
+IMAGE_CACHE = pathlib.Path(
+    os.environ.get("DIB_IMAGE_CACHE", pathlib.Path.home() / ".cache" / "image-create")
+)
 
 
-def __build(diskimage, release, kernel):
+# Image format to the diskimage-builder output type it is made of and if it
+# is compressed with zstd. `raw` is a bare ext4 file system, written to the
+# target partition with dd instead of being unpacked file by file.
+FORMATS = {
+    "tgz": ("tgz", False),
+    "tar.zst": ("tar", True),
+    "raw.zst": ("raw", True),
+}
+
+
+def __build_key(release, kernel, sources_rendered, formats=("tgz",)):
+    """Hash of everything the image is built from"""
+    digest = hashlib.sha256()
+    digest.update(f"{release}\n{','.join(kernel)}\n".encode("utf-8"))
+    digest.update(f"{','.join(sorted(formats))}\n".encode("utf-8"))
+    digest.update(sources_rendered.encode("utf-8"))
+    for path in sorted(ELEMENTS_PATH.rglob("*")):
+        if path.is_file():
+            digest.update(str(path.relative_to(ELEMENTS_PATH)).encode("utf-8"))
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def __build_info_path(diskimage):
+    return pathlib.Path(f"{diskimage}.build.yaml")
+
+
+def __image_base(diskimage):
+    """Image file name without format, e.g. `image` for `image.tgz`"""
+    return diskimage[: -len(".tgz")] if diskimage.endswith(".tgz") else diskimage
+
+
+def __timed(cmd):
+    t_start = time.perf_counter()
+    invoke.run(cmd, hide=True)
+    return round(time.perf_counter() - t_start, 2)
+
+
+def __compress(path, zstd):
+    """Compresses diskimage-builder output `path` with zstd (replacing it),
+    or times gzip, returns compression and decompression times (in seconds)"""
+    if not zstd:
+        # diskimage-builder gzips the tarball itself, the same gzip run on
+        # the unpacked tarball is timed instead
+        decompress = __timed(f"gzip -dc {path} > /dev/null")
+        unpacked = f"{path}.tar"
+        try:
+            invoke.run(f"gzip -dc {path} > {unpacked}", hide=True)
+            compress = __timed(f"gzip -c {unpacked} > /dev/null")
+        finally:
+            pathlib.Path(unpacked).unlink(missing_ok=True)
+        return compress, decompress
+    target = f"{path}.zst"
+    compress = __timed(f"zstd -T0 -q -f --rm {path} -o {target}")
+    decompress = __timed(f"zstd -T0 -q -dc {target} > /dev/null")
+    return compress, decompress
 
-    print(f'Creating "{diskimage}"..')
+
+def __build(diskimage, release, kernel, force=False, formats=("tgz",)):
 
     sources_tmpl = jinja2.Environment(
         loader=jinja2.FileSystemLoader(str(pathlib.Path(__file__).parents[0]))
@@ -21,17 +85,32 @@ def __build(diskimage, release, kernel):
 
     sources_rendered = sources_tmpl.render({"release": release})
 
+    build_key = __build_key(release, kernel, sources_rendered, formats)
+    info_path = __build_info_path(diskimage)
+    base = __image_base(diskimage)
+    image_files = {fmt: pathlib.Path(f"{base}.{fmt}") for fmt in formats}
+    exists = all(path.exists() for path in image_files.values())
+    if not force and exists and info_path.exists():
+        with open(info_path, "r") as stream:
+            if yaml.safe_load(stream).get("key") == build_key:
+                print(f'"{diskimage}" is up to date')
+                return
+
+    print(f'Creating "{diskimage}"..')
+
     with tempfile.NamedTemporaryFile(mode="w", delete=False) as outfile:
         outfile.write(sources_rendered)
         sources_filename = outfile.name
 
     print(f"sources.list rendered to {sources_filename}")
 
+    types = ",".join(sorted({FORMATS[fmt][0] for fmt in formats}))
     cmd = (
         "sudo -E bash -c '"
         "disk-image-create ubuntu twist mainline-kernel"
-        f" -t tgz -o {diskimage}'"
+        f" -t {types} -o {base}'"
     )
+    t_start = time.perf_counter()
     try:
         invoke.run(
             cmd,
@@ -39,26 +118,55 @@ def __build(diskimage, release, kernel):
                 "DIB_KERNEL_VERSIONS": ",".join(kernel),
                 "DIB_APT_SOURCES": sources_filename,
                 "DIB_RELEASE": release,
-                "ELEMENTS_PATH": pathlib.Path(__file__).absolute().parents[0]
-                / "add_elements",
+                "DIB_IMAGE_CACHE": str(IMAGE_CACHE),
+                "ELEMENTS_PATH": ELEMENTS_PATH,
             },
         )
     finally:
         os.unlink(sources_filename)
+    build_seconds = round(time.perf_counter() - t_start, 2)
+
+    # All formats come from one build, so they share its time
+    info = {"build_seconds": build_seconds}
+    for fmt, path in image_files.items():
+        dib_output = pathlib.Path(f"{base}.{FORMATS[fmt][0]}")
+        compress, decompress = __compress(dib_output, FORMATS[fmt][1])
+        info[fmt] = {
+            "file": str(path),
+            "size": path.stat().st_size,
+            "compress_seconds": compress,
+            "decompress_seconds": decompress,
+        }
+        print(
+            f"{fmt:<8} {path.stat().st_size / 2 ** 20:>10.1f} MB"
+            f"  compress {compress:>7.1f} s  decompress {decompress:>7.1f} s"
+        )
+
+    with open(info_path, "w") as stream:
+        yaml.safe_dump(
+            {
+                "key": build_key,
+                "release": release,
+                "kernel": list(kernel),
+                "formats": info,
+            },
+            stream,
+            default_flow_style=False,
+        )
 
     print(f'Done creating "{diskimage}"')
 
 
-def __upload(diskimage):
+def __upload(diskimage, part_size=64, concurrency=8):
     print(f"Uploading {diskimage} to cloud storage..")
-    url = cloudstorage.upload(diskimage, "static")
+    url = cloudstorage.upload(diskimage, "static", part_size, concurrency)
     print(f"Uploaded {diskimage} to cloud storage. URL: {url}")
     return url
 
 
 def __render_rspec(url):
     with open(BASE_PATH / "node_selection" / "hosts", "r") as stream:
-        node_spec = yaml.load(stream)
+        node_spec = yaml.safe_load(stream)
 
     nodes = list()
     for node_type in node_spec:
@@ -103,15 +211,28 @@ def cli(ctx, diskimage, release, kernel):
 
 
 @cli.command()
+@click.option("--force", "-f", is_flag=True, help="Build even if image is up to date")
+@click.option(
+    "--format",
+    "formats",
+    type=click.Choice(list(FORMATS)),
+    multiple=True,
+    default=["tgz"],
+    help="Image format, can be repeated (file name follows diskimage)",
+)
 @click.pass_context
-def build(ctx):
-    __build(ctx.obj["diskimage"], ctx.obj["release"], ctx.obj["kernel"])
+def build(ctx, force, formats):
+    __build(
+        ctx.obj["diskimage"], ctx.obj["release"], ctx.obj["kernel"], force, formats
+    )
 
 
 @cli.command()
+@click.option("--part-size", default=64, help="Multipart upload part size (in MB)")
+@click.option("--concurrency", default=8, help="Number of parts uploaded at once")
 @click.pass_context
-def upload(ctx):
-    __upload(ctx.obj["diskimage"])
+def upload(ctx, part_size, concurrency):
+    __upload(ctx.obj["diskimage"], part_size, concurrency)
 
 
 @cli.command()